@@ -1,70 +1,118 @@
 import os
 import sys
-import cPickle
+from functools import partial
 import h5py
 import numpy as np
 
 import dxtbx
 from cxid9114.spots import count_spots
 from cxid9114 import utils
+from cxid9114.format.FormatXTCD9114 import FormatXTCD9114
+from cxid9114.format.xtc_shards import run_shards, mpi_rank_size
 
 MIN_SPOT_PER_HIT = 30
 output_dir = "."
 
-pickle_fname = sys.argv[1]
-image_fname = sys.argv[2]
-output_tag = sys.argv[3]
-
-print('Loading reflections')
-with open(pickle_fname, 'r') as f:
-    found_refl = cPickle.load(f)
-refl_select = count_spots.ReflectionSelect(found_refl)
-
-print('Loading format')
-loader = dxtbx.load(image_fname)
-imgset = loader.get_imageset(loader.get_image_file())
-
-print('Counting spots')
-idx, Nspot_at_idx = count_spots.count_spots(pickle_fname)
-where_hits = np.where(Nspot_at_idx > MIN_SPOT_PER_HIT)[0]
-Nhits = where_hits.shape[0]
-
-# ============
-output_h5_name = os.path.join(output_dir, 
-    "run%d_hits_%s.h5" % (loader.run_number, output_tag))
-
-with h5py.File( output_h5_name, "w") as out_h5:
-
-    out_h5.create_dataset("panel_masks", data=loader.cspad_mask, dtype=np.bool)
-    out_h5.create_dataset("panel_gainmasks", data=loader.gain)
-    panel_x, panel_y = loader.cspad.coords_xy(loader._get_event(where_hits[0]))
-    out_h5.create_dataset("panel_x", data=panel_x/109.92)
-    out_h5.create_dataset("panel_y", data=panel_y/109.92)
-    out_h5.create_dataset("panel_z", data=np.ones_like(panel_x)*loader.detector_distance)
-    out_h5.create_dataset("pedestal", data=loader.dark)
-    out_h5.create_dataset("gain_val", data=loader.nominal_gain_val)
-
-    panel_dset = out_h5.create_dataset("panels",
-                                       dtype=np.int16,
-                                       shape=(Nhits, 32, 185, 388))
-    times_dset = out_h5.create_dataset("event_times",
-                                       dtype=np.int64,
-                                       shape=(Nhits,))
-    
-    seconds, nanoseconds, fids  = [],[],[]
-    #psana_time_nums = []
-    for i_hit in range(Nhits):
-        print '\rSaving hit {:d}/{:d}'.format(i_hit+1, Nhits),
-        sys.stdout.flush()
-        shot_idx = idx[where_hits[i_hit]]
-        
-        t = loader.times[ shot_idx]  # event time
-        sec, nsec, fid = t.seconds(), t.nanoseconds(), t.fiducial()
-        t_num, _ = utils.make_event_time( sec, nsec, fid)
-        #seconds.append( sec)
-        #nanoseconds.append( nsec)
-        #fids.append( fid)
-        panel_dset[i_hit] = loader.get_psana_raw(shot_idx)
-        times_dset[i_hit] = t_num
-        #psana_time_nums.append( t_num)
 
+def write_hits(loader, hit_idx, output_h5_name):
+    """
+    writes the raw cspad data of the hits, and the calibration, to an hdf5 hit file
+    :param loader: FormatXTCD9114 instance
+    :param hit_idx: loader indices of the hits
+    :param output_h5_name: hit file name, without the panel coordinates if the loader has no events
+    """
+    Nhits = len(hit_idx)
+    with h5py.File( output_h5_name, "w") as out_h5:
+
+        out_h5.create_dataset("panel_masks", data=loader.cspad_mask, dtype=np.bool)
+        out_h5.create_dataset("panel_gainmasks", data=loader.gain)
+        if len(loader.times):  # an empty shard, see merge_hit_files
+            panel_x, panel_y = loader.cspad.coords_xy(loader._get_event(hit_idx[0] if Nhits else 0))
+            out_h5.create_dataset("panel_x", data=panel_x/109.92)
+            out_h5.create_dataset("panel_y", data=panel_y/109.92)
+            out_h5.create_dataset("panel_z", data=np.ones_like(panel_x)*loader.detector_distance)
+        out_h5.create_dataset("pedestal", data=loader.dark)
+        out_h5.create_dataset("gain_val", data=loader.nominal_gain_val)
+
+        panel_dset = out_h5.create_dataset("panels",
+                                           dtype=np.int16,
+                                           shape=(Nhits, 32, 185, 388))
+        times_dset = out_h5.create_dataset("event_times",
+                                           dtype=np.int64,
+                                           shape=(Nhits,))
+
+        for i_hit in range(Nhits):
+            print '\rSaving hit {:d}/{:d}'.format(i_hit+1, Nhits),
+            sys.stdout.flush()
+            shot_idx = hit_idx[i_hit]
+
+            t = loader.times[ shot_idx]  # event time
+            sec, nsec, fid = t.seconds(), t.nanoseconds(), t.fiducial()
+            t_num, _ = utils.make_event_time( sec, nsec, fid)
+            panel_dset[i_hit] = loader.get_psana_raw(shot_idx)
+            times_dset[i_hit] = t_num
+
+
+def write_shard_hits(hit_shots, output_tag, loader):
+    """writes the hits among the events of the loader's shard, :return: the shard's hit file name"""
+    hit_shots = set(hit_shots)
+    hit_idx = [i for i, shot_idx in enumerate(loader.shard_events) if shot_idx in hit_shots]
+    output_h5_name = os.path.join(output_dir, "run%d_hits_%s_shard%d.h5"
+                                  % (loader.run_number, output_tag, loader.shard_index))
+    write_hits(loader, hit_idx, output_h5_name)
+    return output_h5_name
+
+
+def merge_hit_files(shard_names, output_h5_name):
+    """
+    merges the shard hit files into one, hits in event time order, and deletes them.
+    The panel coordinates come from the first shard with events
+    """
+    shards = [h5py.File(name, "r") for name in shard_names]
+    times = np.concatenate([h5["event_times"][()] for h5 in shards])
+    source = [(i_shard, j) for i_shard, h5 in enumerate(shards)
+              for j in range(h5["event_times"].shape[0])]
+    order = np.argsort(times, kind='mergesort')
+    with_coords = [h5 for h5 in shards if "panel_x" in h5]
+    with h5py.File(output_h5_name, "w") as out_h5:
+        for name in ["panel_masks", "panel_gainmasks", "pedestal", "gain_val"]:
+            out_h5.create_dataset(name, data=shards[0][name][()])
+        if with_coords:
+            for name in ["panel_x", "panel_y", "panel_z"]:
+                out_h5.create_dataset(name, data=with_coords[0][name][()])
+        panel_dset = out_h5.create_dataset("panels", dtype=np.int16, shape=(len(times), 32, 185, 388))
+        out_h5.create_dataset("event_times", data=times[order])
+        for i_hit, i_src in enumerate(order):
+            i_shard, j = source[i_src]
+            panel_dset[i_hit] = shards[i_shard]["panels"][j]
+    for h5, name in zip(shards, shard_names):
+        h5.close()
+        os.remove(name)
+
+
+if __name__ == "__main__":
+    pickle_fname = sys.argv[1]
+    image_fname = sys.argv[2]
+    output_tag = sys.argv[3]
+    rank, n_ranks = mpi_rank_size()
+    # > 1 splits the run across processes, under mpirun the ranks (needs d9114.disk_cache in the locator)
+    n_shards = int(sys.argv[4]) if len(sys.argv) > 4 else n_ranks
+    if n_shards == 1 and rank != 0:  # unsharded, every rank would write the same file
+        sys.exit()
+
+    print('Counting spots')
+    idx, Nspot_at_idx = count_spots.count_spots(pickle_fname)
+    where_hits = np.where(Nspot_at_idx > MIN_SPOT_PER_HIT)[0]
+    hit_shots = [idx[i] for i in where_hits]
+
+    if n_shards == 1:
+        print('Loading format')
+        loader = dxtbx.load(image_fname)
+        output_h5_name = os.path.join(output_dir,
+            "run%d_hits_%s.h5" % (loader.run_number, output_tag))
+        write_hits(loader, hit_shots, output_h5_name)
+    else:
+        run_number = FormatXTCD9114.get_params(image_fname).run[0]
+        output_h5_name = os.path.join(output_dir, "run%d_hits_%s.h5" % (run_number, output_tag))
+        run_shards(image_fname, partial(write_shard_hits, hit_shots, output_tag), n_shards=n_shards,
+                   merge=partial(merge_hit_files, output_h5_name=output_h5_name))
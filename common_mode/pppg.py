@@ -1,97 +1,294 @@
+from __future__ import print_function
+import copy
+import ctypes
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
-from scipy.signal import savgol_filter
+from scipy.signal import savgol_coeffs
+from scipy.ndimage import convolve1d
 import matplotlib
 
+CHUNK = 65536  # pixels binned per block, small enough to stay in cache
+
+
+def _bin_index(vals, x1, x2, nbins):
+    """
+    bin of each value in np.histogram(vals, np.linspace(x1, x2, nbins+1)), including
+    its correction of values on the bin edges, plus 1, with 0 the underflow bin
+    and nbins+1 the overflow bin
+    :return: intp array of the bins, -1 for nan and inf values, which np.histogram cannot bin
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    edges = np.linspace(x1, x2, nbins+1)
+    f = vals - x1
+    f *= nbins / float(x2 - x1)
+    finite = np.isfinite(f)
+    f[~finite] = 0
+    np.floor(f, out=f)
+    np.clip(f, 0, nbins - 1, out=f)
+    k = f.astype(np.intp)
+    k[vals < edges[k]] -= 1  # as np.histogram, the edges decide, not the rounding of f
+    k[(vals >= edges[k + 1]) & (k != nbins - 1)] += 1
+    k += 1
+    k[vals < x1] = 0
+    k[vals > x2] = nbins + 1
+    k[~finite] = -1
+    return k
+
+
+def _bin_pixels(values, offsets, x1, x2, nbins, counts):
+    """
+    bins pixel values of all panels into counts in one binned-count pass.
+    Bins match np.histogram(values, np.linspace(x1, x2, nbins+1)), with an added
+    underflow and overflow bin on either side, such that each panel row is nbins+2 long.
+    nan and inf values are not counted
+    :param values: 1d array of pixel values
+    :param offsets: 1d array, position in counts of the row (panel) of each value
+    :param x1: left edge of the histogram
+    :param x2: right edge of the histogram
+    :param nbins: number of histogram bins
+    :param counts: 1d integer array, incremented in place
+    """
+    for i in range(0, len(values), CHUNK):
+        idx = _bin_index(values[i:i+CHUNK], x1, x2, nbins)
+        row = offsets[i:i+CHUNK]
+        if idx.size and idx.min() < 0:  # drop the non-finite values
+            keep = idx >= 0
+            idx, row = idx[keep], row[keep]
+        idx += row
+        counts += np.bincount(idx, minlength=len(counts))
+
+
+def _density(hists, bin_width):
+    """normalize each row of hists like np.histogram(..., density=True)"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return hists / hists.sum(-1)[:, None] / bin_width
+
+
+class PPPGPlan(object):
+    """
+    Per-run plan for pppg common mode correction.
+    The gain map and mask are constant for a run, so the flat pixel indices of each
+    panel gain region, the histogram bins and the smoothing kernel are computed once,
+    and correcting a shot is then a gather, a bincount and a scatter.
+    """
+    PARAMS = ('window_length', 'polyorder', 'low_x1', 'low_x2',
+              'high_x1', 'high_x2', 'Nlow', 'Nhigh')
+    subsample_fraction = 1.
+
+    def __init__(self, gain, mask=None, window_length=101, polyorder=5,
+                 low_x1=-10, low_x2=10, high_x1=-20, high_x2=20, Nhigh=1000, Nlow=500):
+        """
+        :param gain: boolean gain map, True for low gain pixels
+        :param mask: boolean mask, False for pixels to ignore
+        other parameters are as in pppg
+        """
+        gain = np.asarray(gain, dtype=bool)
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            self.is_low = gain & mask
+            self.is_high = mask > gain  # same as (~gain)*mask
+        else:
+            self.is_low = gain
+            self.is_high = ~gain
+        self.shape = gain.shape
+        self.npan = self.shape[0]
+
+        self.window_length = window_length
+        self.polyorder = polyorder
+        self.low_x1, self.low_x2, self.Nlow = low_x1, low_x2, int(Nlow)
+        self.high_x1, self.high_x2, self.Nhigh = high_x1, high_x2, int(Nhigh)
+        self.nbins_low = self.Nlow - 1
+        self.nbins_high = self.Nhigh - 1
+        self.bins_low = np.linspace(low_x1, low_x2, self.Nlow)
+        self.bins_high = np.linspace(high_x1, high_x2, self.Nhigh)
+        self.xdata_low = self.bins_low[1:]*.5 + self.bins_low[:-1]*.5
+        self.xdata_high = self.bins_high[1:]*.5 + self.bins_high[:-1]*.5
+        # savgol_filter(..., mode='constant') is a convolution with these coefficients
+        self.savgol_kernel = savgol_coeffs(window_length, polyorder)
+
+        # flat pixel indices of each gain mode, sorted by panel
+        self.idx_low = np.flatnonzero(self.is_low)
+        self.idx_high = np.flatnonzero(self.is_high)
+        self.Npix_low = np.count_nonzero(self.is_low.reshape((self.npan, -1)), axis=1)
+        self.Npix_high = np.count_nonzero(self.is_high.reshape((self.npan, -1)), axis=1)
+        self.pid_low = np.repeat(np.arange(self.npan, dtype=np.int32), self.Npix_low)
+        self.pid_high = np.repeat(np.arange(self.npan, dtype=np.int32), self.Npix_high)
+        self.low_gain_pid = np.where(self.Npix_low)[0]
+        self.high_gain_pid = np.where(self.Npix_high)[0]
+
+        # position of each pixel's panel row in the shared histogram count array
+        rows_low = np.arange(self.npan)*(self.nbins_low + 2)
+        rows_high = np.arange(self.npan)*(self.nbins_high + 2) + self.npan*(self.nbins_low + 2)
+        self.offsets_low = np.repeat(rows_low, self.Npix_low)
+        self.offsets_high = np.repeat(rows_high, self.Npix_high)
+        self.hist_size = self.npan*(self.nbins_low + 2 + self.nbins_high + 2)
+
+    @classmethod
+    def from_pppg_args(cls, gain, mask, pppg_args):
+        """
+        :param pppg_args: dict of pppg keyword arguments, those not defining the plan are ignored
+        """
+        return cls(gain, mask, **{k: pppg_args[k] for k in cls.PARAMS if k in pppg_args})
+
+    def gather(self, shot):
+        """
+        :param shot: 32 x 185 x 388 cspad data
+        :return: 1d arrays of the low and high gain pixels, sorted by panel
+        """
+        flat = shot.reshape(-1)
+        return flat.take(self.idx_low), flat.take(self.idx_high)
+
+    def histograms(self, pixels_low, pixels_high):
+        """
+        histograms of every panel and both gain modes, in one binned-count pass
+        :param pixels_low: low gain pixels, as returned by gather
+        :param pixels_high: high gain pixels, as returned by gather
+        :return: Npanel x Nbins low gain and high gain histograms
+        """
+        counts = np.zeros(self.hist_size, np.intp)
+        _bin_pixels(pixels_low, self.offsets_low, self.low_x1, self.low_x2, self.nbins_low, counts)
+        _bin_pixels(pixels_high, self.offsets_high, self.high_x1, self.high_x2, self.nbins_high, counts)
+        split = self.npan*(self.nbins_low + 2)
+        hists_low = counts[:split].reshape((self.npan, -1))[:, 1:-1].astype(np.float64)
+        hists_high = counts[split:].reshape((self.npan, -1))[:, 1:-1].astype(np.float64)
+        return hists_low, hists_high
+
+    def smooth(self, hists):
+        """savgol smoothing of all panel histograms at once"""
+        return convolve1d(hists, self.savgol_kernel, axis=-1, mode='constant')
+
+    def peak_shifts(self, hists_low, hists_high):
+        """
+        :return: Npanel arrays of the low and high gain shifts, 0 where a panel has no pixels of that gain
+        """
+        shifts_low = self.xdata_low[np.argmax(self.smooth(hists_low), axis=-1)]
+        shifts_high = self.xdata_high[np.argmax(self.smooth(hists_high), axis=-1)]
+        shifts_low[self.Npix_low == 0] = 0
+        shifts_high[self.Npix_high == 0] = 0
+        return shifts_low, shifts_high
+
+    def shifts(self, shot):
+        """
+        :param shot: 32 x 185 x 388 cspad data
+        :return: Npanel arrays of the low and high gain shifts
+        """
+        return self.peak_shifts(*self.histograms(*self.gather(shot)))
+
+    def subtract(self, shot, shifts_low, shifts_high):
+        """
+        subtracts the per-panel shifts from each gain region of shot, in place
+        """
+        np.subtract(shot, shifts_low[:, None, None], out=shot, where=self.is_low)
+        np.subtract(shot, shifts_high[:, None, None], out=shot, where=self.is_high)
+
+    @staticmethod
+    def _stratified(idx, Npix, fraction):
+        """
+        evenly spaced subsample of the pixels of each panel
+        :param idx: flat pixel indices, sorted by panel
+        :param Npix: number of pixels in each panel
+        :param fraction: fraction of the pixels of each panel to keep, at least 1 is kept
+        :return: positions in idx of the kept pixels, and the number kept per panel
+        """
+        Nsub = np.where(Npix > 0, np.maximum(1, np.round(Npix*fraction)), 0).astype(int)
+        starts = np.cumsum(Npix) - Npix
+        keep = [start + (np.arange(nsub)*(npix / float(nsub))).astype(int)
+                for start, npix, nsub in zip(starts, Npix, Nsub) if nsub > 0]
+        keep = np.concatenate(keep) if keep else np.zeros(0, int)
+        return keep, Nsub
+
+    def subsample(self, fraction):
+        """
+        approximate plan, which estimates the shifts from a deterministic, stratified subsample
+        of the pixels of each panel gain region. Shifts are still subtracted from all pixels.
+        :param fraction: fraction of the pixels used, between 0 and 1
+        :return: a new PPPGPlan
+        """
+        if fraction >= 1:
+            return self
+        sub = copy.copy(self)
+        sub.subsample_fraction = fraction
+        keep_low, sub.Npix_low = self._stratified(self.idx_low, self.Npix_low, fraction)
+        keep_high, sub.Npix_high = self._stratified(self.idx_high, self.Npix_high, fraction)
+        for name, keep in [('idx_low', keep_low), ('pid_low', keep_low), ('offsets_low', keep_low),
+                           ('idx_high', keep_high), ('pid_high', keep_high), ('offsets_high', keep_high)]:
+            setattr(sub, name, getattr(self, name)[keep])
+        return sub
+
+
 # @profile
-def pppg(shot_, gain, mask=None, window_length=101, polyorder=5,
+def pppg(shot_, gain=None, mask=None, window_length=101, polyorder=5,
         low_x1=-10, low_x2 = 10, high_x1=-20, high_x2=20, Nhigh=1000,
          Nlow=500, plot_details=False, verbose=False, before_and_after=False,
-         plot_metric=True, inplace=False):
-
+         plot_metric=True, inplace=False, plan=None):
+    """
+    per panel per gain (pppg) common mode correction. The zero-photon peak of
+    each panel gain region is located by smoothing the pixel histogram, and then
+    subtracted from the pixels of that region.
+    All panels are histogrammed in one binned-count pass and smoothed together.
+    :param plan: PPPGPlan instance, if given, gain, mask and the histogram and
+        smoothing parameters are taken from the plan
+    """
     if not inplace:
         shot = shot_.copy()
     else:
         shot = shot_
-    if mask is not None:
-        is_low = gain*mask
-        is_high = (~gain)*mask
-    else:
-        is_low = gain
-        is_high = (~gain)
+    if plan is None:
+        plan = PPPGPlan(gain, mask, window_length=window_length, polyorder=polyorder,
+                        low_x1=low_x1, low_x2=low_x2, high_x1=high_x1, high_x2=high_x2,
+                        Nhigh=Nhigh, Nlow=Nlow)
 
-    low_gain_pid = np.where([ np.any( is_low[i] ) for i in range(32)])[0]
-    high_gain_pid = np.where([ np.any( is_high[i] ) for i in range(32)])[0]
+    pixels_low, pixels_high = plan.gather(shot)
+    hists_low, hists_high = plan.histograms(pixels_low, pixels_high)
+    shifts_low, shifts_high = plan.peak_shifts(hists_low, hists_high)
+    xdata_low, xdata_high = plan.xdata_low, plan.xdata_high
+    low_gain_pid, high_gain_pid = plan.low_gain_pid, plan.high_gain_pid
 
-    bins_low = np.linspace(low_x1, low_x2, Nlow)
-    bins_high = np.linspace(high_x1,high_x2,Nhigh)
+    common_mode_shifts = {}
+    for i_pan in low_gain_pid:
+        common_mode_shifts[(i_pan, 'low')] = shifts_low[i_pan]
+    for i_pan in high_gain_pid:
+        common_mode_shifts[(i_pan, 'high')] = shifts_high[i_pan]
 
-    xdata_low = bins_low[1:]*.5 + bins_low[:-1]*.5
-    xdata_high = bins_high[1:]*.5 + bins_high[:-1]*.5
+    if plot_details or verbose:
+        for which, pids, xdata, hists, shifts, Npix_mode in [
+                ('low', low_gain_pid, xdata_low, hists_low, shifts_low, plan.Npix_low),
+                ('high', high_gain_pid, xdata_high, hists_high, shifts_high, plan.Npix_high)]:
+            smoothed = plan.smooth(hists)
+            for i_pan in pids:
+                shift = shifts[i_pan]
+                if plot_details:
+                    Npix = Npix_mode[i_pan]
+                    pk_val = np.argmax(smoothed[i_pan])
+                    plt.figure()
+                    ax = plt.gca()
+                    ax.plot( xdata, hists[i_pan], '.')
+                    ax.plot( xdata, smoothed[i_pan], lw=2)
+                    ax.plot( xdata-shift, smoothed[i_pan], lw=2)
+                    ax.plot( shift, smoothed[i_pan][pk_val], 's', mfc=None, mec='Deeppink', mew=2 )
+                    ax.set_title("Panel has %d pixels, Shift amount = %.3f"%( Npix, shift))
+                    plt.show()
+                if verbose:
+                    print("shifted panel %d by %.4f"% ( i_pan, shift))
 
     if before_and_after:
-        before_low = []
-        after_low = []
-        before_high = []
-        after_high = []
+        width_low = plan.bins_low[1] - plan.bins_low[0]
+        width_high = plan.bins_high[1] - plan.bins_high[0]
+        before_low = list(_density(hists_low, width_low)[low_gain_pid])
+        before_high = list(_density(hists_high, width_high)[high_gain_pid])
+        hists_low, hists_high = plan.histograms(pixels_low - shifts_low[plan.pid_low],
+                                                pixels_high - shifts_high[plan.pid_high])
+        after_low = list(_density(hists_low, width_low)[low_gain_pid])
+        after_high = list(_density(hists_high, width_high)[high_gain_pid])
+
+    plan.subtract(shot, shifts_low, shifts_high)
 
-    common_mode_shifts = {}
-    for i_pan in low_gain_pid:
-        pixels = shot[i_pan][ is_low[i_pan] ]
-        Npix = is_low[i_pan].sum()
-        pix_hist = np.histogram( pixels, bins=bins_low, normed=True)[0]
-        smoothed_hist = savgol_filter( pix_hist, window_length=window_length,
-                                    mode='constant',polyorder=polyorder)
-        pk_val = np.argmax(smoothed_hist)
-        shift = xdata_low[pk_val ]
-        common_mode_shifts[ (i_pan, 'low') ] = shift
-        if plot_details:
-            plt.figure()
-            ax = plt.gca()
-            ax.plot( xdata_low, pix_hist, '.')
-            ax.plot( xdata_low, smoothed_hist, lw=2)
-            ax.plot( xdata_low-shift, smoothed_hist, lw=2)
-            ax.plot( shift, smoothed_hist[pk_val], 's', mfc=None, mec='Deeppink', mew=2 )
-            ax.set_title("Panel has %d pixels, Shift amount = %.3f"%( Npix, shift))
-            plt.show()
-        if verbose:
-            print("shifted panel %d by %.4f"% ( i_pan, shift))
-        if before_and_after:
-            before_low.append( pix_hist)
-            pix_hist_shifted = np.histogram( pixels-shift, bins=bins_low, normed=True)[0]
-            after_low.append( pix_hist_shifted)
-    for i_pan in high_gain_pid:
-        pixels = shot[i_pan][ is_high[i_pan] ]
-        Npix = is_high[i_pan].sum()
-        pix_hist = np.histogram( pixels, bins=bins_high, normed=True)[0]
-        smoothed_hist = savgol_filter( pix_hist, window_length=window_length,mode='constant', polyorder=polyorder)
-        pk_val=np.argmax(smoothed_hist)
-        shift = xdata_high[pk_val]
-        common_mode_shifts[ (i_pan, 'high') ] = shift
-        if plot_details:
-            plt.figure()
-            ax = plt.gca()
-            ax.plot( xdata_high, pix_hist, '.')
-            ax.plot( xdata_high, smoothed_hist, lw=2)
-            ax.plot( xdata_high-shift, smoothed_hist, lw=2)
-            ax.plot( shift,  smoothed_hist[pk_val], 's', mfc=None, mec='Deeppink', mew=2 )
-            ax.set_title("Panel has %d pixels, Shift amount = %.3f"%( Npix, shift))
-            plt.show()
-        if verbose:
-            print("shifted panel %d by %.4f"%(i_pan,shift))
-        if before_and_after:
-            before_high.append( pix_hist)
-            pix_hist_shifted = np.histogram( pixels-shift, bins=bins_high, normed=True)[0]
-            after_high.append( pix_hist_shifted)
-
-    for (i_pan,which), shift in common_mode_shifts.items():
-        if which =='low':
-            shot[i_pan][ is_low[i_pan]] = shot[i_pan][ is_low[i_pan]] - shift
-        if which == 'high':
-            shot[i_pan][ is_high[i_pan]] = shot[i_pan][ is_high[i_pan]] - shift
     if verbose:
-        print("Mean shift: %.4f"%(np.mean(common_mode_shifts.values())))
+        print("Mean shift: %.4f"%(np.mean(list(common_mode_shifts.values()))))
     if plot_metric:
-        print shot.shape, shot_.shape
+        print(shot.shape, shot_.shape)
         plt.figure()
         plt.plot( np.median( np.median(shot_,-1),-1), 'bo', ms=10, label='before')
         plt.plot( np.median( np.median(shot,-1),-1), 's', ms=10,color='Darkorange', label='after')
@@ -104,6 +301,139 @@ def pppg(shot_, gain, mask=None, window_length=101, polyorder=5,
     else:
         return shot
 
+# set in each pppg_batch worker process by _batch_init
+_BATCH = {}
+
+
+def _batch_init(buff, shape, dtype, plan):
+    """pool initializer, views the shared frame stack without copying it"""
+    _BATCH['shots'] = np.frombuffer(buff, dtype=dtype).reshape(shape)
+    _BATCH['plan'] = plan
+
+
+def _batch_correct(shot_indices, shots=None, plan=None):
+    """applies the plan to shots[shot_indices] in place"""
+    if shots is None:
+        shots = _BATCH['shots']
+        plan = _BATCH['plan']
+    for i_shot in shot_indices:
+        shot = shots[i_shot]
+        plan.subtract(shot, *plan.shifts(shot))
+
+
+def shared_stack(shape, dtype=np.float64):
+    """
+    :return: zeroed array in shared memory, pppg_batch corrects such a stack in place
+        in process mode without copying it
+    """
+    dtype = np.dtype(dtype)
+    buff = RawArray('b', int(np.prod(shape))*dtype.itemsize)
+    return np.frombuffer(buff, dtype=dtype).reshape(shape)
+
+
+def _shared_buffer(arr):
+    """:return: the RawArray arr spans exactly, if it is a shared_stack, else None"""
+    base = arr
+    while isinstance(base, np.ndarray):
+        base = base.base
+    if isinstance(base, ctypes.Array) and arr.flags.c_contiguous \
+            and arr.nbytes == ctypes.sizeof(base) \
+            and arr.__array_interface__['data'][0] == ctypes.addressof(base):
+        return base
+    return None
+
+
+def pppg_batch(shots, gain=None, mask=None, plan=None, nproc=None, use_threads=False,
+               inplace=False, chunksize=1, **pppg_args):
+    """
+    pppg common mode correction of a stack of shots, split across a pool of workers.
+    In process mode workers correct a stack in shared memory in place, so frames are
+    never pickled. A stack made with shared_stack is used directly, any other stack is
+    copied into shared memory, and copied back when inplace.
+    :param shots: N x 32 x 185 x 388 stack of cspad data
+    :param gain: boolean gain map, True for low gain pixels
+    :param mask: boolean mask, False for pixels to ignore
+    :param plan: PPPGPlan instance, made from gain, mask and pppg_args if None
+    :param nproc: number of workers, defaults to the number of cpus
+    :param use_threads: use a thread pool instead of a process pool
+    :param inplace: correct shots in place, otherwise return a corrected stack
+    :param chunksize: number of shots sent to a worker at a time
+    :param pppg_args: histogram and smoothing parameters of pppg
+    :return: the corrected stack, or None if inplace
+    """
+    if plan is None:
+        plan = PPPGPlan.from_pppg_args(gain, mask, pppg_args)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    Nshot = len(shots)
+    tasks = [range(i, min(i+chunksize, Nshot)) for i in range(0, Nshot, chunksize)]
+
+    if use_threads or nproc == 1:
+        out = shots if inplace else shots.copy()
+        if nproc == 1:
+            for task in tasks:
+                _batch_correct(task, out, plan)
+        else:
+            pool = ThreadPool(nproc)
+            try:
+                pool.map(lambda task: _batch_correct(task, out, plan), tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return None if inplace else out
+
+    buff = _shared_buffer(shots) if inplace else None
+    if buff is not None:
+        out = shots
+    else:
+        buff = RawArray('b', shots.nbytes)
+        out = np.frombuffer(buff, dtype=shots.dtype).reshape(shots.shape)
+        out[:] = shots
+    pool = multiprocessing.Pool(nproc, initializer=_batch_init,
+                                initargs=(buff, shots.shape, shots.dtype, plan))
+    try:
+        pool.map(_batch_correct, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    if inplace:
+        if out is not shots:
+            shots[:] = out
+        return None
+    return out
+
+
+def subsample_error_report(shots, plan, fractions=(0.5, 0.2, 0.1, 0.05), verbose=True):
+    """
+    error of the subsampled pppg shifts, with respect to the full pppg shifts
+    :param shots: iterable of 32 x 185 x 388 dark subtracted frames, e.g. from a reference run
+    :param plan: full PPPGPlan
+    :param fractions: subsample fractions to test
+    :param verbose: print a table of the errors
+    :return: dict of fraction -> dict of rms, 99th percentile and max absolute shift error (ADU)
+    """
+    subplans = {frac: plan.subsample(frac) for frac in fractions}
+    diffs = {frac: [] for frac in fractions}
+    for shot in shots:
+        full_low, full_high = plan.shifts(shot)
+        for frac, subplan in subplans.items():
+            sub_low, sub_high = subplan.shifts(shot)
+            diffs[frac].append(sub_low[plan.low_gain_pid] - full_low[plan.low_gain_pid])
+            diffs[frac].append(sub_high[plan.high_gain_pid] - full_high[plan.high_gain_pid])
+    report = {}
+    for frac in fractions:
+        d = np.abs(np.concatenate(diffs[frac]))
+        report[frac] = {"rms": np.sqrt(np.mean(d**2)),
+                        "p99": np.percentile(d, 99),
+                        "max": d.max()}
+    if verbose:
+        print("fraction    rms      p99      max   (ADU, bin width low=%.3f high=%.3f)"
+              % (plan.bins_low[1] - plan.bins_low[0], plan.bins_high[1] - plan.bins_high[0]))
+        for frac in fractions:
+            print("%8.3f %8.4f %8.4f %8.4f" % ((frac,) + tuple(report[frac][k] for k in ("rms", "p99", "max"))))
+    return report
+
+
 # @profile
 def main():
     from mask import mask_utils
@@ -121,7 +451,7 @@ def main():
     dark = det.pedestals(62)
     shots = []
     for i in range( Nshot):
-        print i
+        print(i)
         ev = events.next()
         if ev is None:
             continue
@@ -0,0 +1,115 @@
+from __future__ import print_function
+import os
+import zlib
+import h5py
+import numpy as np
+
+
+def plan_fingerprint(plan, algo='pppg', dark=None):
+    """
+    attributes that identify the common mode shifts of a plan,
+    cached shifts are only reused if these match
+    :param plan: PPPGPlan
+    :param algo: name of the common mode estimator
+    :param dark: pedestal subtracted before the common mode, the shifts depend on it
+    :return: dict
+    """
+    fp = {k: getattr(plan, k) for k in plan.PARAMS}
+    fp["subsample_fraction"] = plan.subsample_fraction
+    fp["algo"] = algo
+    fp["gain_mask_crc"] = zlib.crc32(np.packbits(plan.is_low).tobytes()
+                                     + np.packbits(plan.is_high).tobytes()) & 0xffffffff
+    if dark is not None:
+        fp["dark_crc"] = zlib.crc32(np.ascontiguousarray(dark, dtype=np.float64).tobytes()) & 0xffffffff
+    return fp
+
+
+class ShiftCache(object):
+    """
+    HDF5 sidecar of the per-panel, per-gain common mode shifts of each shot.
+    Each shot is a 2 x Npanel dataset (low gain row, high gain row) in the shifts group,
+    named by its key. The fingerprint of the plan is stored as attributes, and the
+    cache is cleared if it does not match.
+    Only the process that opened the sidecar for writing writes to it. If it cannot be
+    opened for writing (read-only directory, or held by another process) it is read
+    only, and if it cannot be read either, or is stale and read-only, the cache is off.
+    """
+    def __init__(self, filename, fingerprint):
+        """
+        :param filename: path to the sidecar file, created if it doesnt exist
+        :param fingerprint: dict, e.g. the output of plan_fingerprint
+        """
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self._pid = os.getpid()
+        self._h5, self.writable = self._open(filename)
+        if self._h5 is not None and not (self._matches() and "shifts" in self._h5):
+            if self.writable:
+                if "shifts" in self._h5:
+                    del self._h5["shifts"]
+                for k, v in fingerprint.items():
+                    self._h5.attrs[k] = v
+                self._h5.create_group("shifts")
+            else:  # stale shifts of another plan
+                self._h5.close()
+                self._h5 = None
+        self._shifts = None if self._h5 is None else self._h5["shifts"]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _open(filename):
+        """:return: the sidecar file and whether it is writable, the file is None if it cannot be opened"""
+        for mode in ('a', 'r'):
+            try:
+                return h5py.File(filename, mode), mode == 'a'
+            except (IOError, OSError):
+                pass
+        return None, False
+
+    @property
+    def enabled(self):
+        return self._h5 is not None
+
+    def _matches(self):
+        attrs = self._h5.attrs
+        return all(k in attrs and np.all(attrs[k] == v) for k, v in self.fingerprint.items())
+
+    def get(self, key):
+        """
+        :param key: shot index
+        :return: shifts_low, shifts_high or None if the shot is not cached
+        """
+        name = str(key)
+        if self._shifts is None or name not in self._shifts:
+            self.misses += 1
+            return None
+        self.hits += 1
+        shifts = self._shifts[name][()]
+        return shifts[0], shifts[1]
+
+    def put(self, key, shifts_low, shifts_high):
+        """stores the shifts of shot key, if this is the process writing the sidecar"""
+        if not self.writable or os.getpid() != self._pid:
+            return
+        name = str(key)
+        try:
+            if name in self._shifts:
+                del self._shifts[name]
+            self._shifts.create_dataset(name, data=np.array([shifts_low, shifts_high]))
+            self._h5.flush()
+        except (IOError, OSError):
+            self.writable = False
+
+    def __contains__(self, key):
+        return self._shifts is not None and str(key) in self._shifts
+
+    def __len__(self):
+        return 0 if self._shifts is None else len(self._shifts)
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+            self._shifts = None
+            self.writable = False
@@ -0,0 +1,111 @@
+from __future__ import print_function
+import numpy as np
+
+from cxid9114.common_mode.pppg import _bin_index
+
+
+class WarmStartCommonMode(object):
+    """
+    Common mode estimator for sequential streams of shots, where panel offsets drift slowly.
+    Each panel's zero-photon peak is searched for in a narrow ADU window around the
+    previous shot's shift, using the bins and smoothing of the plan, so the shift is the
+    pppg shift whenever the peak is inside the window. Panels whose peak is not found
+    (it lies on the window edge, or the window has too few pixels) fall back to the
+    full pppg search.
+    """
+    def __init__(self, plan, half_width=1., min_counts=100):
+        """
+        :param plan: PPPGPlan, defines the pixels, the histogram bins and the smoothing
+        :param half_width: half width in ADU of the search window around the previous shift
+        :param min_counts: minimum number of pixels inside the window for the peak to be trusted
+        """
+        self.plan = plan
+        self.half_width = half_width
+        self.min_counts = min_counts
+        # the window histograms use the plan's bins, plus enough bins either side that their
+        # smoothing is the same as pppg's, so a peak found in the window is the pppg peak
+        self.pad = len(plan.savgol_kernel) // 2
+        self.width_low = (plan.low_x2 - plan.low_x1) / float(plan.nbins_low)
+        self.width_high = (plan.high_x2 - plan.high_x1) / float(plan.nbins_high)
+        self.half_low = int(round(half_width / self.width_low))
+        self.half_high = int(round(half_width / self.width_high))
+        self.prev_low = None
+        self.prev_high = None
+        self.Nfallback = 0  # number of panel gain regions that needed the full search
+
+    def reset(self):
+        """forget the previous shifts, e.g. at the start of a new run"""
+        self.prev_low = None
+        self.prev_high = None
+
+    def _window_shifts(self, pixels, prev, x1, x2, nbins, xdata, half, Npix):
+        """
+        histograms each panel's pixels in a window of bins centered on its previous shift
+        :return: Npanel shifts, and whether each panel's peak was found inside its window,
+            or None, None if the window is as large as the full histogram
+        """
+        npan = self.plan.npan
+        ntot = 2*(half + self.pad) + 1
+        if ntot >= nbins:
+            return None, None
+        row = ntot + 2  # under and overflow bins
+        center = np.round((prev - x1) / (x2 - x1) * nbins - .5).astype(np.intp)
+        k0 = np.clip(center - half - self.pad, 0, nbins - ntot)  # first plan bin of each window
+        # pixels are sorted by panel, so each panel is binned from a slice of pixels with
+        # scalar window offsets. The bins are those of _bin_pixels, so pixels land in the
+        # same bins as in the full histogram
+        counts = np.zeros((npan, row), np.intp)
+        stops = np.cumsum(Npix)
+        for i_pan in np.flatnonzero(Npix):
+            vals = pixels[stops[i_pan] - Npix[i_pan]: stops[i_pan]]
+            idx = _bin_index(vals, x1, x2, nbins)
+            idx = idx[idx >= 0]  # drops the non-finite values
+            idx -= k0[i_pan]
+            np.clip(idx, 0, ntot + 1, out=idx)
+            counts[i_pan] = np.bincount(idx, minlength=row)
+        hists = counts[:, 1:-1].astype(np.float64)
+        smoothed = self.plan.smooth(hists)
+
+        # bins whose smoothing is exact: all of them at the ends of the full histogram,
+        # otherwise all but the pad bins
+        j = np.arange(ntot)
+        first = np.where(k0 == 0, 0, self.pad)
+        last = np.where(k0 == nbins - ntot, ntot, ntot - self.pad)
+        valid = (j >= first[:, None]) & (j < last[:, None])
+        smoothed[~valid] = -np.inf
+        k = np.argmax(smoothed, axis=-1)
+        found = (k > first) & (k < last - 1) & (np.sum(hists*valid, -1) >= self.min_counts)
+        shifts = xdata[k0 + k]
+        shifts[Npix == 0] = 0
+        found[Npix == 0] = True
+        return shifts, found
+
+    def shifts(self, shot):
+        """
+        :param shot: 32 x 185 x 388 cspad data
+        :return: Npanel arrays of the low and high gain shifts
+        """
+        plan = self.plan
+        pixels_low, pixels_high = plan.gather(shot)
+        if self.prev_low is None:
+            shifts_low, shifts_high = plan.peak_shifts(*plan.histograms(pixels_low, pixels_high))
+        else:
+            shifts_low, found_low = self._window_shifts(
+                pixels_low, self.prev_low, plan.low_x1, plan.low_x2,
+                plan.nbins_low, plan.xdata_low, self.half_low, plan.Npix_low)
+            shifts_high, found_high = self._window_shifts(
+                pixels_high, self.prev_high, plan.high_x1, plan.high_x2,
+                plan.nbins_high, plan.xdata_high, self.half_high, plan.Npix_high)
+            if found_low is None or found_high is None:
+                shifts_low, shifts_high = plan.peak_shifts(*plan.histograms(pixels_low, pixels_high))
+            elif not (found_low.all() and found_high.all()):
+                self.Nfallback += np.sum(~found_low) + np.sum(~found_high)
+                full_low, full_high = plan.peak_shifts(*plan.histograms(pixels_low, pixels_high))
+                shifts_low[~found_low] = full_low[~found_low]
+                shifts_high[~found_high] = full_high[~found_high]
+        self.prev_low, self.prev_high = shifts_low, shifts_high
+        return shifts_low, shifts_high
+
+    def subtract(self, shot, shifts_low, shifts_high):
+        """subtracts the shifts from each gain region of shot, in place"""
+        self.plan.subtract(shot, shifts_low, shifts_high)
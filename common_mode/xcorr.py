@@ -0,0 +1,110 @@
+from __future__ import print_function
+import numpy as np
+
+
+def _parabolic_peak(corr):
+    """
+    sub-sample location of the maximum of each row of corr
+    :param corr: N x M array
+    :return: N array of fractional indices
+    """
+    i_max = np.argmax(corr, axis=-1)
+    rows = np.arange(corr.shape[0])
+    left = corr[rows, i_max - 1]
+    mid = corr[rows, i_max]
+    right = corr[rows, (i_max + 1) % corr.shape[1]]
+    denom = left - 2*mid + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(denom < 0, 0.5*(left - right) / denom, 0)
+    return i_max + delta
+
+
+class TemplateCommonMode(object):
+    """
+    Common mode estimator that cross-correlates each panel histogram with a
+    zero-photon peak template. The template is built once per run, and the
+    shifts are found to sub-bin precision, so the histograms (set by the plan)
+    can be coarser than for pppg.
+
+    Until the template is built, shifts are found with pppg, and the first
+    Ntemplate shots are used to build the template.
+    """
+    def __init__(self, plan, Ntemplate=5):
+        """
+        :param plan: PPPGPlan, defines the pixels and histogram bins
+        :param Ntemplate: number of shots used to build the template
+        """
+        self.plan = plan
+        self.Ntemplate = Ntemplate
+        self.template_low = None
+        self.template_high = None
+        self._sum_low = np.zeros(plan.nbins_low)
+        self._sum_high = np.zeros(plan.nbins_high)
+        self._Nshots = 0
+
+    @property
+    def has_template(self):
+        return self.template_low is not None
+
+    @staticmethod
+    def _aligned(hists, xdata, shifts, pids):
+        """sum of the histograms of panels pids, each resampled so its peak is at 0"""
+        aligned = [np.interp(xdata + shifts[i], xdata, hists[i], left=0, right=0)
+                   for i in pids]
+        return np.sum(aligned, axis=0) if aligned else 0
+
+    def add_to_template(self, hists_low, hists_high, shifts_low, shifts_high):
+        """
+        adds one shot's panel histograms, centered on their pppg shifts, to the template
+        """
+        plan = self.plan
+        self._sum_low += self._aligned(hists_low, plan.xdata_low, shifts_low, plan.low_gain_pid)
+        self._sum_high += self._aligned(hists_high, plan.xdata_high, shifts_high, plan.high_gain_pid)
+        self._Nshots += 1
+        if self._Nshots >= self.Ntemplate:
+            self.template_low = self._sum_low / max(self._sum_low.sum(), 1)
+            self.template_high = self._sum_high / max(self._sum_high.sum(), 1)
+
+    def build_template(self, shots):
+        """
+        :param shots: iterable of 32 x 185 x 388 cspad frames (dark subtracted)
+        """
+        for shot in shots:
+            hists = self.plan.histograms(*self.plan.gather(shot))
+            self.add_to_template(*(hists + self.plan.peak_shifts(*hists)))
+
+    @staticmethod
+    def _xcorr_shifts(hists, template, xdata):
+        """
+        FFT cross-correlation of all panel histograms with the template
+        :return: Npanel array of shifts
+        """
+        nbins = len(template)
+        nfft = 2*nbins
+        corr = np.fft.irfft(np.fft.rfft(hists, nfft, axis=-1)
+                            * np.conj(np.fft.rfft(template, nfft))[None], nfft, axis=-1)
+        lag = _parabolic_peak(corr)
+        lag[lag >= nbins] -= nfft  # negative lags wrap around
+        # the template is centered on 0, so a lag of k bins is a shift of k bin widths
+        return lag * (xdata[1] - xdata[0])
+
+    def shifts(self, shot):
+        """
+        :param shot: 32 x 185 x 388 cspad data
+        :return: Npanel arrays of the low and high gain shifts
+        """
+        plan = self.plan
+        hists_low, hists_high = plan.histograms(*plan.gather(shot))
+        if not self.has_template:
+            shifts_low, shifts_high = plan.peak_shifts(hists_low, hists_high)
+            self.add_to_template(hists_low, hists_high, shifts_low, shifts_high)
+            return shifts_low, shifts_high
+        shifts_low = self._xcorr_shifts(hists_low, self.template_low, plan.xdata_low)
+        shifts_high = self._xcorr_shifts(hists_high, self.template_high, plan.xdata_high)
+        shifts_low[plan.Npix_low == 0] = 0
+        shifts_high[plan.Npix_high == 0] = 0
+        return shifts_low, shifts_high
+
+    def subtract(self, shot, shifts_low, shifts_high):
+        """subtracts the shifts from each gain region of shot, in place"""
+        self.plan.subtract(shot, shifts_low, shifts_high)
@@ -151,3 +151,184 @@ def fit_high_gain_dist(xdata, ydata, plot=False):
         plt.pause(0.1)
 
     return gauss0,gauss1, result
+
+
+BATCH_PARAM_NAMES = ('amp0', 'mu0', 'wid0', 'alpha0', 'amp1', 'mu1', 'wid1', 'alpha1')
+
+
+def _skew_gauss_and_jac(x, amp, mu, wid, alpha, with_alpha=True):
+    """
+    skew_gauss of N parameter sets and its analytic derivatives
+    :param x: nbins array
+    :param amp, mu, wid, alpha: N arrays
+    :param with_alpha: if False, alpha is taken to be 0 (a plain Gauss) and its derivative is not computed
+    :return: N x nbins model, and N x 4 x nbins derivatives w.r.t. amp, mu, wid, alpha
+    """
+    amp, mu, wid, alpha = [p[:, None] for p in (amp, mu, wid, alpha)]
+    dx = x[None] - mu
+    z = dx / wid
+    E = np.exp(-z**2)
+    G = amp*E
+    jac = np.zeros((G.shape[0], 4, G.shape[1]))
+    if not with_alpha:  # skew_gauss with alpha=0 is Gauss
+        jac[:, 0] = E
+        jac[:, 1] = G*2*z/wid
+        jac[:, 2] = jac[:, 1]*z
+        return G, jac
+    C = 0.5*(1 + erf(alpha*dx / np.sqrt(2)))
+    dC = np.exp(-0.5*(alpha*dx)**2) / np.sqrt(2*np.pi)  # derivative of C w.r.t. alpha*dx
+    model = 2*G*C
+    jac[:, 0] = 2*E*C
+    jac[:, 1] = 2*(G*2*z/wid*C - G*dC*alpha)
+    jac[:, 2] = 2*G*2*z**2/wid*C
+    jac[:, 3] = 2*G*dC*dx
+    return model, jac
+
+
+def _gauss_and_skewgauss_batch(x, p, with_alpha=(True, True)):
+    """
+    :param p: N x 8 parameters in the order of BATCH_PARAM_NAMES
+    :param with_alpha: whether the alpha of each peak is used, see _skew_gauss_and_jac
+    :return: N x nbins model and N x 8 x nbins jacobian
+    """
+    model0, jac0 = _skew_gauss_and_jac(x, *p[:, :4].T, with_alpha=with_alpha[0])
+    model1, jac1 = _skew_gauss_and_jac(x, *p[:, 4:].T, with_alpha=with_alpha[1])
+    return model0 + model1, np.concatenate((jac0, jac1), axis=1)
+
+
+def _to_bounded(u, lower, upper):
+    """
+    lmfit (MINUIT) bounds transform from the unbounded internal parameters u
+    :return: the parameters and their derivatives w.r.t. u
+    """
+    both = np.isfinite(lower) & np.isfinite(upper)
+    low_only = np.isfinite(lower) & ~np.isfinite(upper)
+    up_only = ~np.isfinite(lower) & np.isfinite(upper)
+    p = u.copy()
+    dp = np.ones_like(u)
+    root = np.sqrt(u**2 + 1)
+    with np.errstate(invalid='ignore'):
+        p = np.where(both, lower + (np.sin(u) + 1)*(upper - lower)/2., p)
+        dp = np.where(both, np.cos(u)*(upper - lower)/2., dp)
+        p = np.where(low_only, lower - 1 + root, p)
+        p = np.where(up_only, upper + 1 - root, p)
+        dp = np.where(low_only, u/root, np.where(up_only, -u/root, dp))
+    return p, dp
+
+
+def _from_bounded(p, lower, upper):
+    """inverse of _to_bounded"""
+    both = np.isfinite(lower) & np.isfinite(upper)
+    low_only = np.isfinite(lower) & ~np.isfinite(upper)
+    up_only = ~np.isfinite(lower) & np.isfinite(upper)
+    with np.errstate(invalid='ignore'):
+        u = np.where(both, np.arcsin(np.clip(2*(p - lower)/(upper - lower) - 1, -1, 1)), p)
+        u = np.where(low_only, np.sqrt(np.maximum((p - lower + 1)**2 - 1, 0)), u)
+        u = np.where(up_only, np.sqrt(np.maximum((upper - p + 1)**2 - 1, 0)), u)
+    return u
+
+
+def batch_fit_gauss_and_skewgauss(xdata, ydata, params, max_iter=200, tol=1.5e-8):
+    """
+    fits gauss_and_skewgauss to many histograms at once with a vectorized Levenberg-Marquardt,
+    using the analytic jacobian. Parameter bounds are handled with the same transform as lmfit.
+    :param xdata: nbins array
+    :param ydata: N x nbins array of histograms, e.g. the per-shot distributions of a gain survey
+    :param params: lmfit.Parameters with initial values, bounds and vary flags,
+        e.g. LOW_GAIN_GAUSS_PARAMS, missing alpha0/alpha1 are fixed at 0
+    :param max_iter: maximum number of iterations
+    :param tol: rows stop when the relative decrease of chi-squared is below tol
+    :return: dict of N arrays of each parameter in BATCH_PARAM_NAMES, plus chisqr and success,
+        True for rows that met tol (not those that hit max_iter or whose damping blew up)
+    """
+    xdata = np.asarray(xdata, dtype=np.float64)
+    ydata = np.atleast_2d(np.asarray(ydata, dtype=np.float64))
+    N = ydata.shape[0]
+    good = np.all(np.isfinite(ydata), axis=-1)
+    ydata = np.where(np.isfinite(ydata), ydata, 0)
+
+    init = np.zeros(len(BATCH_PARAM_NAMES))
+    lower = np.full(len(BATCH_PARAM_NAMES), -np.inf)
+    upper = np.full(len(BATCH_PARAM_NAMES), np.inf)
+    free = np.zeros(len(BATCH_PARAM_NAMES), bool)
+    for i, name in enumerate(BATCH_PARAM_NAMES):
+        if name in params:
+            par = params[name]
+            init[i] = par.value
+            lower[i] = par.min
+            upper[i] = par.max
+            free[i] = par.vary
+    #   starting on a bound the bounds transform has zero slope, so start just inside
+    span = np.where(np.isfinite(upper - lower), upper - lower, 1.)
+    init = np.where(free, np.clip(init, lower + 1e-3*span, upper - 1e-3*span), init)
+    #   peaks with a fixed alpha of 0 are plain gaussians, skip the erf
+    with_alpha = tuple(bool(free[i] or init[i] != 0) for i in (3, 7))
+    free_idx = np.flatnonzero(free)
+    lower, upper = lower[free_idx], upper[free_idx]
+
+    def evaluate(p, u, ydata):
+        p[:, free_idx], dp = _to_bounded(u, lower, upper)
+        model, jac = _gauss_and_skewgauss_batch(xdata, p, with_alpha)
+        resid = model - ydata
+        return resid, jac[:, free_idx]*dp[:, :, None], np.sum(resid**2, -1)
+
+    p = np.tile(init, (N, 1))
+    u = np.tile(_from_bounded(init[free_idx], lower, upper), (N, 1))
+    resid, jac, chisq = evaluate(p, u, ydata)
+    lam = np.full(N, 1e-3)
+    nu = np.full(N, 2.)
+    active = good.copy()
+    converged_rows = np.zeros(N, bool)
+    eye = np.eye(len(free_idx))
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        rows = np.flatnonzero(active)
+        J = jac[rows]
+        JTJ = np.matmul(J, J.transpose(0, 2, 1))
+        grad = np.matmul(J, resid[rows][..., None])[..., 0]
+        diag = np.einsum('npp->np', JTJ)
+        #   floor the damping of parameters the model barely depends on (e.g. a tightly bound mu0)
+        diag = np.maximum(diag, 1e-6*diag.max(-1)[:, None])
+        A = JTJ + (lam[rows, None]*diag + 1e-15)[:, :, None]*eye
+        step = -np.linalg.solve(A, grad[..., None])[..., 0]
+        u_new = u[rows] + step
+        p_new = p[rows].copy()
+        resid_new, jac_new, chisq_new = evaluate(p_new, u_new, ydata[rows])
+
+        #   damping update of Nielsen (1999), from the ratio of the actual to predicted decrease
+        predicted = np.sum(step*(lam[rows, None]*diag*step - grad), -1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rho = (chisq[rows] - chisq_new) / predicted
+        better = rho > 0
+        acc = rows[better]
+        #   as MINPACK ftol, both the actual and predicted relative decrease are below tol
+        converged = (np.abs(chisq[rows] - chisq_new) <= tol*chisq[rows]) & (predicted <= tol*chisq[rows])
+        u[acc] = u_new[better]
+        p[acc] = p_new[better]
+        jac[acc] = jac_new[better]
+        resid[acc] = resid_new[better]
+        chisq[acc] = chisq_new[better]
+        lam[acc] *= np.maximum(1/3., 1 - (2*rho[better] - 1)**3)
+        nu[acc] = 2.
+        rej = rows[~better]
+        lam[rej] *= nu[rej]
+        nu[rej] *= 2
+        converged_rows[rows[converged]] = True
+        active[rows[converged | (lam[rows] > 1e10)]] = False
+
+    result = {name: p[:, i] for i, name in enumerate(BATCH_PARAM_NAMES)}
+    chisq[~good] = np.nan
+    result["chisqr"] = chisq
+    result["success"] = good & converged_rows
+    return result
+
+
+def batch_fit_low_gain_dists(xdata, ydata):
+    """fit_low_gain_dist for N x nbins histograms, see batch_fit_gauss_and_skewgauss"""
+    return batch_fit_gauss_and_skewgauss(xdata, ydata, LOW_GAIN_GAUSS_PARAMS)
+
+
+def batch_fit_high_gain_dists(xdata, ydata):
+    """fit_high_gain_dist for N x nbins histograms, see batch_fit_gauss_and_skewgauss"""
+    return batch_fit_gauss_and_skewgauss(xdata, ydata, HIGH_GAIN_GAUSS_PARAMS)
@@ -1,5 +1,10 @@
 from __future__ import absolute_import, division
 
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import h5py
 import numpy as np
 try:
@@ -15,7 +20,12 @@ from dials.array_family import flex
 
 from cxid9114.geom import geom_utils
 from cxid9114.parameters import WAVELEN_LOW
-from cxid9114.common_mode.pppg import pppg
+from cxid9114.common_mode.pppg import PPPGPlan
+from cxid9114.common_mode.xcorr import TemplateCommonMode
+from cxid9114.common_mode.warm_start import WarmStartCommonMode
+from cxid9114.common_mode.shift_cache import ShiftCache, plan_fingerprint
+from cxid9114.format.correct_utils import FrameCorrector, FrameCache, \
+    CorrectedFrameStore, CorrectionPool, calibration_fingerprint, calibration_cache, cached
 
 # required HDF5 keys
 REQUIRED_KEYS = ['gain_val',
@@ -45,17 +55,63 @@ PPPG_ARGS = {'Nhigh': 100.0,
              'polyorder': 3,
              'verbose': False,
              'window_length': 51}
+PPPG_SUBSAMPLE_FRACTION = 1.  # < 1 estimates the common mode from a subsample of pixels
+COMMON_MODE_ALGO = 'pppg'  # or 'xcorr', template cross-correlation, see common_mode/xcorr.py
+                            # or 'pppg_warm', searches near the previous shot's shifts, see common_mode/warm_start.py
+XCORR_TEMPLATE_SHOTS = 5
+WARM_START_HALF_WIDTH = 1.  # ADU
+CACHE_SHIFTS = False  # store common mode shifts per shot in a <hit file>.cmshifts.h5 sidecar
+CORRECTION_DTYPE = np.float64  # np.float32 halves the memory traffic of frame correction
+BATCH_READ_FRAMES = 16  # most frames read in one hyperslab by get_raw_data_batch and iter_raw_data
+PREFETCH_DEPTH = 4  # frames read ahead by iter_raw_data
+FRAME_CACHE_MBYTES = 200  # memory budget of the cache of corrected frames, 0 disables it
+STORE_CORRECTED = False  # write corrected frames (float32) to a <hit file>.corrected.h5 sidecar, and reuse them,
+                         # needs COMMON_MODE_ALGO 'pppg'
+CORRECTION_PROCESSES = 0  # > 0 corrects the frames of get_raw_data_batch and iter_raw_data in a pool of worker processes,
+                          # needs COMMON_MODE_ALGO 'pppg' and CACHE_SHIFTS False (see correct_utils.CorrectionPool)
+PIXEL_GAIN_FILE = None  # per-pixel gain map file written by pixel_gain.save_gain_map, used in place of gain_val
+GAIN_CORRECTOR_FILE = None  # hdf5 file of a gain_utils.GainCorrector (see its save), used in place of gain_val
+
+def _calibration_attribute(name):
+    """:return: property of the calibration attribute name, loaded on first access"""
+    def get(self):
+        if name not in self.__dict__:
+            self._calibration_define()
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, value):
+        self._calibration_define()  # so that a value set before the first access is kept
+        self.__dict__[name] = value
+    return property(get, set)
+
 
 class FormatHDF5D9114(FormatHDF5, FormatStill):
     """
     Class for reading D9114 HDF5 hit files
     script (this script lives on the SACLA hpc).
     """
+    dark = _calibration_attribute("dark")
+    gain = _calibration_attribute("gain")
+    gain_val = _calibration_attribute("gain_val")
+    pixel_gain = _calibration_attribute("pixel_gain")
+    gain_corrector = _calibration_attribute("gain_corrector")
+    mask = _calibration_attribute("mask")
+    panel_X = _calibration_attribute("panel_X")
+    panel_Y = _calibration_attribute("panel_Y")
+    panel_Z = _calibration_attribute("panel_Z")
+    pppg_plan = _calibration_attribute("pppg_plan")
+    corrector = _calibration_attribute("corrector")
+    frame_cache = _calibration_attribute("frame_cache")
+    frame_store = _calibration_attribute("frame_store")
+    assembler = _calibration_attribute("assembler")
+
     @staticmethod
     def understand(image_file):
-        h5_handle = h5py.File(image_file, 'r')
-        h5_keys = h5_handle.keys()
-        understood = all([k in h5_keys for k in REQUIRED_KEYS])
+        with h5py.File(image_file, 'r') as h5_handle:
+            understood = all([k in h5_handle for k in REQUIRED_KEYS])
         return understood
 
     def __init__(self, image_file, **kwargs):
@@ -66,13 +122,29 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
 
         #def _start(self):
         self._h5_handle = h5py.File(self.get_image_file(), 'r')
+        # calibration arrays and models shared with other instances reading this file
+        self._calib_cache = calibration_cache(self.get_image_file())
         self._decide_multi_panel()
-        self.load_dark()
-        self.load_gain()
-        self.load_mask()
-        self.load_xyz()
         self._geometry_define()
-        self._assembler_define()
+        self._calibrated = False  # the calibration is loaded on first access of it or of the data
+        self._calibrating = False
+        self._correction_pool = None
+
+    def _calibration_define(self):
+        if self._calibrated or self._calibrating:
+            return
+        self._calibrating = True
+        try:
+            self.load_dark()
+            self.load_gain()
+            self.load_mask()
+            self.load_xyz()
+            self._pppg_plan_define()
+            self._corrector_define()
+            self._assembler_define()
+            self._calibrated = True
+        finally:
+            self._calibrating = False
 
     def _decide_multi_panel(self):
         """
@@ -87,23 +159,82 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
             self.as_multi_panel = False
 
 
+    def _read_calibration(self, key):
+        """reads dataset key, or returns it from the calibration cache"""
+        return cached(self._calib_cache, key, lambda: self._h5_handle[key][()])
+
     def load_dark(self):
-        self.dark = self._h5_handle["pedestal"][()]
+        self.dark = self._read_calibration("pedestal")
         assert (self.dark.dtype == np.float64)
 
     def load_gain(self):
-        self.gain = self._h5_handle["panel_gainmasks"][()]
+        self.gain = self._read_calibration("panel_gainmasks")
         assert (self.gain.dtype == np.bool)
-        self.gain_val = self._h5_handle["gain_val"][()]
+        self.gain_val = self._read_calibration("gain_val")
+        self.pixel_gain = None
+        if PIXEL_GAIN_FILE is not None:
+            from cxid9114.pixel_gain import load_gain_map
+            self.pixel_gain = cached(calibration_cache(PIXEL_GAIN_FILE), "pixel_gain_map",
+                                     lambda: load_gain_map(PIXEL_GAIN_FILE))
+        self.gain_corrector = None
+        if GAIN_CORRECTOR_FILE is not None:
+            from cxid9114.gain_utils import GainCorrector
+            self.gain_corrector = cached(calibration_cache(GAIN_CORRECTOR_FILE), "gain_corrector",
+                                         lambda: GainCorrector.load(GAIN_CORRECTOR_FILE))
 
     def load_mask(self):
-        self.mask = self._h5_handle["panel_masks"][()]
+        self.mask = self._read_calibration("panel_masks")
         assert (self.mask.dtype == np.bool)
 
     def load_xyz(self):
-        self.panel_X = self._h5_handle["panel_x"][()]
-        self.panel_Y = self._h5_handle["panel_y"][()]
-        self.panel_Z = self._h5_handle["panel_z"][()]
+        self.panel_X = self._read_calibration("panel_x")
+        self.panel_Y = self._read_calibration("panel_y")
+        self.panel_Z = self._read_calibration("panel_z")
+
+    def _pppg_plan_define(self):
+        """gain map and mask are fixed per file, so the common mode plan is made once"""
+        key = ("pppg_plan", str(sorted(PPPG_ARGS.items())), PPPG_SUBSAMPLE_FRACTION)
+        self.pppg_plan = cached(self._calib_cache, key, lambda: PPPGPlan.from_pppg_args(
+            self.gain, self.mask, PPPG_ARGS).subsample(PPPG_SUBSAMPLE_FRACTION))
+
+    def _corrector_define(self):
+        if COMMON_MODE_ALGO == 'xcorr':
+            common_mode = TemplateCommonMode(self.pppg_plan, XCORR_TEMPLATE_SHOTS)
+        elif COMMON_MODE_ALGO == 'pppg_warm':
+            common_mode = WarmStartCommonMode(self.pppg_plan, WARM_START_HALF_WIDTH)
+        else:
+            common_mode = self.pppg_plan
+        shift_cache = None
+        if CACHE_SHIFTS:
+            shift_cache = ShiftCache(self.get_image_file() + ".cmshifts.h5",
+                                     plan_fingerprint(self.pppg_plan, COMMON_MODE_ALGO,
+                                                      dark=self.dark))
+            if not shift_cache.enabled:
+                shift_cache = None
+        self.corrector = FrameCorrector(self.dark, self.gain, self.mask, self.gain_val,
+                                        plan=common_mode, dtype=CORRECTION_DTYPE,
+                                        shift_cache=shift_cache, pixel_gain=self.pixel_gain,
+                                        gain_corrector=self.gain_corrector)
+        self._raw_panels = np.empty(self._h5_handle["panels"].shape[1:],
+                                    self._h5_handle["panels"].dtype)
+        self.frame_cache = FrameCache(FRAME_CACHE_MBYTES)
+        self._asic_buffer = np.empty((64, 185, 194), np.float64)  # for psana_data_to_aaron64_data
+        self.frame_store = None
+        if STORE_CORRECTED:
+            if COMMON_MODE_ALGO != 'pppg':  # the shifts of xcorr and pppg_warm depend on the frames read before
+                raise ValueError("STORE_CORRECTED needs COMMON_MODE_ALGO 'pppg', not %s" % COMMON_MODE_ALGO)
+            params = plan_fingerprint(self.pppg_plan, COMMON_MODE_ALGO)
+            params["xcorr_template_shots"] = XCORR_TEMPLATE_SHOTS
+            params["warm_start_half_width"] = WARM_START_HALF_WIDTH
+            params["gain_val"] = self.gain_val
+            if self.gain_corrector is not None:
+                params["gain_corrector"] = (self.gain_corrector.gain, self.gain_corrector.bg_gain,
+                                            self.gain_corrector.cutoff)
+            fingerprint = calibration_fingerprint(
+                [self.dark, self.gain, self.mask, self.pixel_gain], params)
+            self.frame_store = CorrectedFrameStore(self.get_image_file() + ".corrected.h5",
+                                                   self.get_num_images(), self._raw_panels.shape,
+                                                   fingerprint, source=self.get_image_file())
 
     def _assembler_define(self):
         if not self.as_multi_panel:
@@ -111,9 +242,9 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
             bins1 = np.arange(-IMG_SIZE[1]/2, IMG_SIZE[1]/2+1)
             assert(len(bins0) == IMG_SIZE[0]+1)
             assert(len(bins1) == IMG_SIZE[1]+1)
-            self.hist_args = {"x": self.panel_X.ravel(),
-                              "y": self.panel_Y.ravel(),
-                              "bins": [bins0, bins1]}
+            assembler = cached(self._calib_cache, ("assembler", IMG_SIZE),
+                               lambda: geom_utils.PanelAssembler(self.panel_X, self.panel_Y, [bins0, bins1]))
+            self.assembler = assembler.copy()  # own image buffer
 
     def _geometry_define(self):
         if not self.as_multi_panel:
@@ -138,9 +269,13 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
                     trusted_range)
 
         else:
-            psf = self._h5_handle["psf"][()]
-            psf[0, :, 2] = -1*CAMERA_LENGTH*1000
-            self._cctbx_detector = geom_utils.make_dials_cspad(psf)
+            def make_detector():
+                psf = self._h5_handle["psf"][()]
+                psf[0, :, 2] = -1*CAMERA_LENGTH*1000
+                return geom_utils.make_dials_cspad(psf).to_dict()
+            # each instance gets its own model, refinement may change it
+            detector = cached(self._calib_cache, ("detector", CAMERA_LENGTH), make_detector)
+            self._cctbx_detector = self._detector_factory.from_dict(detector)
 
         self._cctbx_beam = self._beam_factory.simple(WAVELEN_LOW)
 
@@ -149,11 +284,8 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
 
     def assemble(self, panels):
         if not self.as_multi_panel:
-            return np.histogram2d(
-                x=self.hist_args["x"],
-                y=self.hist_args["y"],
-                bins=self.hist_args["bins"],
-                weights=panels.ravel())[0]
+            self._calibration_define()
+            return self.assembler.assemble(panels).copy()
 
     def show_image(self, index, **kwargs):
         if self.as_multi_panel:
@@ -170,37 +302,194 @@ class FormatHDF5D9114(FormatHDF5, FormatStill):
 
     def _assemble_panels(self):
         if not self.as_multi_panel:
-            self.panel_img = np.histogram2d(
-                x=self.hist_args["x"],
-                y=self.hist_args["y"],
-                bins=self.hist_args["bins"],
-                weights=self.panels.ravel())[0]
-            self.panel_img = np.ascontiguousarray(self.panel_img)
+            self.panel_img = self.assembler.assemble(self.panels)  # reused buffer
 
     def _correct_raw_data(self, index):
-        self.panels = self._h5_handle['panels'][index].astype(np.float64)  # 32x185x388 psana-style cspad array
-        self._correct_panels()  # applies dark cal, common mode, and gain, in that order..
+        """
+        sets self.panels to the corrected panels of index. self.panels is the correctors
+        buffer, overwritten by the next read, or a frame owned by the frame cache,
+        copy it to keep it
+        """
+        self._calibration_define()
+        frame = self._kept_frame(index)
+        if frame is not None:
+            self.panels = frame
+        else:
+            self._read_and_correct(index)
+
+    def _read_and_correct(self, index):
+        """reads and corrects the panels of index into self.panels, and keeps them"""
+        self._h5_handle['panels'].read_direct(self._raw_panels, np.s_[index])  # 32x185x388 psana-style cspad array
+        self._correct_panels(index)  # applies dark cal, common mode, and gain, in that order..
+        self._keep_frame(index, self.panels)
+
+    def _is_kept(self, index):
+        return index in self.frame_cache or (self.frame_store is not None and index in self.frame_store)
+
+    def _kept_frame(self, index):
+        """
+        :return: the corrected panels of index from the frame cache, or from the
+            frame store (read into the correctors buffer, and cached), or None
+        """
+        frame = self.frame_cache.get(index)
+        if frame is None and self.frame_store is not None:
+            frame = self.frame_store.get(index, out=self.corrector.buffer)
+            if frame is not None:
+                self.frame_cache.put(index, frame)
+        return frame
+
+    def _keep_frame(self, index, panels):
+        """writes the corrected panels of index through to the frame store and the frame cache"""
+        if self.frame_store is not None:
+            self.frame_store.put(index, panels)
+        self.frame_cache.put(index, panels)
 
     def get_raw_data(self, index=0):
         self._correct_raw_data(index)
+        return self._panels_to_raw_data()
+
+    def _panels_to_raw_data(self):
         if not self.as_multi_panel:  # is single slab detector
             self._assemble_panels()
             return flex.double(self.panel_img)
         else:  # if multi-panel detector
-            return geom_utils.psana_data_to_aaron64_data(self.panels, as_flex=True)
-
-    def _apply_mask(self):
-        self.panels *= self.mask
-
-    def _correct_panels(self):
-        self.panels = self.panels.astype(np.float64)
-        self.panels -= self.dark
-        self._apply_mask()
-        pppg(self.panels,
-             self.gain,
-             self.mask,
-             **PPPG_ARGS)
-        self.panels[self.gain] = self.panels[self.gain]*self.gain_val
+            return geom_utils.psana_data_to_aaron64_data(self.panels, as_flex=True,
+                                                         buffer=self._asic_buffer)
+
+    def _read_raw_frames(self, indices):
+        """
+        yields index, raw panels for each of indices, runs of contiguous
+        indices are read in single hyperslab reads of up to BATCH_READ_FRAMES frames
+        """
+        indices = list(indices)
+        panels = self._h5_handle["panels"]
+        i = 0
+        while i < len(indices):
+            j = i + 1
+            while j < len(indices) and indices[j] == indices[j-1] + 1 and j - i < BATCH_READ_FRAMES:
+                j += 1
+            block = panels[indices[i]: indices[i] + j - i]
+            for k in range(j - i):
+                yield indices[i + k], block[k]
+            i = j
+
+    def get_raw_data_batch(self, indices):
+        """
+        :param indices: shot indices
+        :return: list of get_raw_data(index) for each index
+        """
+        self._calibration_define()
+        raw_data = []
+        for index, panels in self._corrected_frames(indices):
+            self.panels = panels
+            raw_data.append(self._panels_to_raw_data())
+        return raw_data
+
+    def _corrected_frames(self, indices, prefetch=0):
+        """
+        yields index, corrected panels for each of indices. Frames in the frame cache or
+        store are taken from there, the others are read (ahead by a background thread
+        if prefetch > 0), corrected and kept
+        """
+        indices = list(indices)
+        missing = [not self._is_kept(index) for index in indices]
+        to_read = [index for index, miss in zip(indices, missing) if miss]
+        if prefetch > 0:
+            frames = self._prefetch_raw_frames(to_read, prefetch)
+        else:
+            frames = self._read_raw_frames(to_read)
+        corrected = self._correct_frames(frames)
+        try:
+            for index, miss in zip(indices, missing):
+                if miss:
+                    index, panels = next(corrected)
+                    self._keep_frame(index, panels)
+                else:
+                    panels = self._kept_frame(index)
+                    if panels is None:  # evicted from the frame cache since
+                        self._read_and_correct(index)
+                        panels = self.panels
+                yield index, panels
+        finally:
+            corrected.close()
+
+    def _correct_frames(self, frames):
+        """
+        yields index, corrected panels for each index, raw panels of frames,
+        corrected in the worker pool if CORRECTION_PROCESSES > 0
+        """
+        if CORRECTION_PROCESSES > 0:
+            if self._correction_pool is None:
+                self._correction_pool = CorrectionPool(self.corrector, self._raw_panels.dtype,
+                                                       nproc=CORRECTION_PROCESSES)
+            for item in self._correction_pool.correct_iter(frames):
+                yield item
+        else:
+            for index, raw in frames:
+                yield index, self.corrector.correct(raw, key=index)
+
+    def close_correction_pool(self):
+        if self._correction_pool is not None:
+            self._correction_pool.close()
+            self._correction_pool = None
+
+    def iter_raw_data(self, indices, prefetch=PREFETCH_DEPTH):
+        """
+        yields index, get_raw_data(index) for each of indices, frames are read
+        by a background thread into a queue of at most prefetch frames, so
+        reading overlaps with the correction of the previous frames
+        """
+        self._calibration_define()
+        corrected = self._corrected_frames(indices, prefetch)
+        try:
+            for index, panels in corrected:
+                self.panels = panels
+                yield index, self._panels_to_raw_data()
+        finally:
+            corrected.close()
+
+    def _prefetch_raw_frames(self, indices, prefetch):
+        """yields index, raw panels for each of indices, read ahead by a background thread"""
+        frames = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def read():
+            try:
+                for item in self._read_raw_frames(indices):
+                    if stop.is_set():
+                        return
+                    frames.put(item)
+            except Exception as err:
+                frames.put(err)
+            frames.put(done)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item = frames.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while reader.is_alive():  # unblock the reader if the iteration stopped early
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    reader.join(0.01)
+
+    def _correct_panels(self, index=None):
+        """
+        fused correction of the raw int16 panels into the correctors buffer,
+        self.panels is overwritten by the next call
+        :param index: shot index, key of the common mode shift cache
+        """
+        self.panels = self.corrector.correct(self._raw_panels, key=index)
 
     def get_detectorbase(self, index=None):
         raise NotImplementedError
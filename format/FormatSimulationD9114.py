@@ -28,9 +28,8 @@ class FormatSimulationD9114(FormatHDF5, FormatStill):
     """
     @staticmethod
     def understand(image_file):
-        h5_handle = h5py.File(image_file, 'r')
-        h5_keys = h5_handle.keys()
-        understood = all([k in h5_keys for k in REQUIRED_KEYS])
+        with h5py.File(image_file, 'r') as h5_handle:
+            understood = all([k in h5_handle for k in REQUIRED_KEYS])
         return understood
 
     def __init__(self, image_file, **kwargs):
@@ -41,6 +40,13 @@ class FormatSimulationD9114(FormatHDF5, FormatStill):
 
         self._h5_handle = h5py.File(self.get_image_file(), 'r')
         self._geometry_define()
+        self._buffers_define()
+
+    def _buffers_define(self):
+        """frames are read one at a time into reused buffers, see utils.SimviewWriter"""
+        images = self._h5_handle["simulated_d9114_images"]
+        self._frame = np.empty(images.shape[1:], images.dtype)
+        self.panel_img = np.empty(images.shape[1:], np.float64)
 
     def _geometry_define(self):
         orig_x = -IMG_SIZE[0]*PIXEL_SIZE*.5
@@ -78,14 +84,24 @@ class FormatSimulationD9114(FormatHDF5, FormatStill):
             print("Cannot plot")
 
     def load_panel_img(self, index):
-        self.panel_img = self._h5_handle["simulated_d9114_images"][index]
-        if not self.panel_img.dtype == np.float64:
-            self.panel_img = self.panel_img.astype(np.float64)
+        """reads image index into self.panel_img, which is overwritten by the next call"""
+        self._h5_handle["simulated_d9114_images"].read_direct(self._frame, np.s_[index])
+        np.copyto(self.panel_img, self._frame)
 
     def get_raw_data(self, index=0):
         self.load_panel_img(index)
         return flex.double(self.panel_img)
 
+    def iter_raw_data(self, indices=None):
+        """
+        yields index, get_raw_data(index) for each of indices, reading one image at a time
+        :param indices: image indices, defaults to all images
+        """
+        if indices is None:
+            indices = range(self.get_num_images())
+        for index in indices:
+            yield index, self.get_raw_data(index)
+
     def get_detectorbase(self, index=None):
         raise NotImplementedError
 
@@ -1,5 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
+import os
+import glob
+import threading
+
 import numpy as np
 try:
     import psana
@@ -12,8 +16,14 @@ try:
 except ImportError:
     CAN_PLOT=False
 from xfel.cxi.cspad_ana.cspad_tbx import env_distance
-from cxid9114.common_mode.pppg import pppg
+from cxid9114.common_mode.pppg import PPPGPlan
+from cxid9114.common_mode.xcorr import TemplateCommonMode
+from cxid9114.common_mode.warm_start import WarmStartCommonMode
+from cxid9114.common_mode.shift_cache import ShiftCache, plan_fingerprint
+from cxid9114.format.correct_utils import FrameCorrector, FrameCache, EventPipeline, \
+    calibration_cache, cached
 from cxid9114.mask import mask_utils
+from cxid9114.geom import geom_utils
 from cxid9114.parameters import WAVELEN_LOW
 # from cxid9114 import assemble_cspad
 # from scitbx import matrix
@@ -29,7 +39,7 @@ d9114_locator_str = """
   d9114 {
     common_mode_algo = something # put this here to break the understand so D9114 doesnt override XTCCspad by default
       .type = str
-      .help = Common mode correction ppg default or unbonded
+      .help = Common mode correction pppg, pppg_warm, xcorr, default or unbonded
     low_gain_zero_peak = (-5,5,100)
         .type = floats(size=3)
         .help = a numpy linspace specifying the ADU extent of the low-gain 0-photon peak 
@@ -43,11 +53,56 @@ d9114_locator_str = """
         .type = int
         .help = window size of for the savgol smoothing, should be odd \
                 (in relation to the low/high gain zero peak region)
+    pppg_subsample_fraction = 1.0
+        .type = float
+        .help = fraction of the pixels of each panel used to estimate the common mode \
+                shifts (stratified subsample), 1 uses all pixels
+    shift_cache = None
+        .type = path
+        .help = hdf5 file storing the pppg/xcorr common mode shifts of each event, \
+                reused on later reads of the same event. With n_shards > 1 each shard \
+                has its own file, suffixed .shard<shard_index>
+    xcorr_template_shots = 5
+        .type = int
+        .help = number of shots, corrected with pppg, used to build the zero-photon \
+                peak template of the xcorr common mode algo
+    frame_cache_mbytes = 200
+        .type = float
+        .help = memory budget of the cache of corrected events, 0 disables it
+    warm_start_half_width = 1.0
+        .type = float
+        .help = half width (ADU) of the window around the previous event's shift searched \
+                by the pppg_warm common mode algo, for events read in sequence
+    disk_cache = False
+        .type = bool
+        .help = keep the event times and the calibration (pedestal, gain map, geometry) \
+                of each run in npz files, written on first open and read afterwards. \
+                The calibration file is tied to the calibration store files of the detector, \
+                a new deploy of them is read from the store again
+    cache_dir = None
+        .type = path
+        .help = directory of the disk_cache files, defaults to ~/.cache/cxid9114
+    n_shards = 1
+        .type = int
+        .help = number of shards the events of the run are split into, e.g. one per worker process
+    shard_index = 0
+        .type = int
+        .help = shard read by this instance, it sees the events shard_index, \
+                shard_index + n_shards, shard_index + 2*n_shards, ... of the run
+    gain_corrector = None
+        .type = path
+        .help = hdf5 file of a gain_utils.GainCorrector (see its save), corrects the low gain \
+                pixels in place of the nominal gain value
+    prefetch_depth = 0
+        .type = int
+        .help = events read and corrected ahead of the caller by background threads, \
+                while events are requested in sequence, 0 disables the prefetch
     }
 """
 
 d9114_locator_scope = phil.parse(d9114_locator_str + locator_str + cspad_locator_str,
                                  process_includes=True)
+_PARAMS_CACHE = {}  # fetched locator scope of each (path, mtime), see get_params
 
 # load some masks
 MASK1 = mask_utils.load_mask("detail_mask")
@@ -55,29 +110,122 @@ MASK2 = mask_utils.load_mask("corners_mask")
 MASK3 = mask_utils.load_mask("small_regions_mask")
 CSPAD_MASK = MASK1*MASK2*MASK3
 
+
+def disk_cache_file(params, run_number, kind, env):
+    """
+    :param params: locator params
+    :param kind: "events", the event index, or "calib", the calibration
+    :param env: psana env of the run. The calib file name holds the latest modification
+        time of the detector's files in its calibration store, so a new deploy gets a new file
+    :return: path of the disk cache file of kind for the run, or None if d9114.disk_cache is off
+    """
+    if not params.d9114.disk_cache:
+        return None
+    directory = params.d9114.cache_dir
+    if directory is None:
+        directory = os.path.join(os.path.expanduser("~"), ".cache", "cxid9114")
+    detector = params.detector_address[0]
+    if kind == "calib":
+        files = glob.glob(os.path.join(env.calibDir(), "*", detector, "*", "*"))
+        kind = "calib_%d" % int(max([os.path.getmtime(f) for f in files] or [0]))
+    return os.path.join(directory, "%s_r%04d_%s.%s.npz"
+                        % (params.experiment, run_number, detector.replace(":", "_").replace(".", "_"), kind))
+
+
+def _save_npz(fname, **arrays):
+    """writes arrays to fname atomically, so concurrent workers never read a partial file"""
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    if not os.path.isdir(os.path.dirname(fname)):
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError:  # made by another worker, or not writable, then open fails below
+            pass
+    try:
+        with open(tmp, "wb") as fid:
+            np.savez(fid, **arrays)
+        os.rename(tmp, fname)
+    except (IOError, OSError) as err:
+        print("Could not write %s: %s" % (fname, err))
+
+
+def read_calibration(cspad, run_number):
+    """:return: dict of the pedestal, gain map, nominal gain and geometry (psf) of the run from the calibration store"""
+    geom = cspad.geometry(run_number)
+    return {"dark": cspad.pedestals(run_number).astype(np.float64),
+            "gain": cspad.gain_mask(run_number) == 1.,
+            "gain_val": cspad._gain_mask_factor,
+            "psf": list(map(np.array, zip(*geom.get_psf())))}
+
+
+def write_calibration_file(fname, calib):
+    _save_npz(fname, dark=calib["dark"], gain=calib["gain"],
+              gain_val=calib["gain_val"], psf=np.array(calib["psf"]))
+
+
+def load_calibration_file(fname):
+    npz = np.load(fname)
+    return {"dark": npz["dark"], "gain": npz["gain"],
+            "gain_val": float(npz["gain_val"]), "psf": list(npz["psf"])}
+
+
+def write_event_index(fname, times):
+    """writes the psana event times of a run"""
+    _save_npz(fname,
+              seconds=np.array([t.seconds() for t in times], np.int64),
+              nanoseconds=np.array([t.nanoseconds() for t in times], np.int64),
+              fiducials=np.array([t.fiducial() for t in times], np.int64))
+
+
+def load_event_index(fname):
+    """:return: the psana event times written by write_event_index"""
+    index = np.load(fname)
+    return [psana.EventTime(int((sec << 32) | nsec), int(fid)) for sec, nsec, fid
+            in zip(index["seconds"].tolist(), index["nanoseconds"].tolist(),
+                   index["fiducials"].tolist())]
+
+
 class FormatXTCD9114(FormatXTCCspad):
     run_number = None  # type: int
 
-    def __init__(self, image_file, **kwargs):
+    def __init__(self, image_file, shard_index=None, n_shards=None, **kwargs):
+        """
+        :param shard_index: shard of the events to read, overrides d9114.shard_index
+        :param n_shards: number of shards, overrides d9114.n_shards
+        """
         assert (self.understand(image_file))
+        # psana is not thread safe, every call to it holds this lock, as the prefetch pipeline
+        # calls it from its threads. Reentrant, as _get_event is called holding it
+        self._psana_lock = threading.RLock()
         FormatXTCCspad.__init__(self, image_file, locator_scope=d9114_locator_scope, **kwargs)
 
         self._ds = FormatXTC._get_datasource(image_file, self.params)
         self.run_number = self.params.run[0]
+        self.n_shards = self.params.d9114.n_shards if n_shards is None else n_shards
+        self.shard_index = self.params.d9114.shard_index if shard_index is None else shard_index
+        if not 0 <= self.shard_index < self.n_shards:
+            raise ValueError("shard_index must be in [0, n_shards)")
         self.cspad = psana.Detector(self.params.detector_address[0])
-        self.dark = self.cspad.pedestals(self.run_number).astype(np.float64)
-        self.gain = self.cspad.gain_mask(self.run_number) == 1.
+        # event times, pedestal, gain map, geometry and pppg plan of the run are shared
+        # by the instances of this process reading the same locator file
+        self._calib_cache = calibration_cache(image_file)
+        self._calib_key = (self.run_number, self.params.detector_address[0])
+        calib = cached(self._calib_cache, ("calib",) + self._calib_key, self._load_calibration)
+        self.dark = calib["dark"]
+        self.gain = calib["gain"]
         if CSPAD_MASK is not None:
             self.cspad_mask = CSPAD_MASK
         else:
             self.cspad_mask = np.ones_like( self.gain)
-        self.nominal_gain_val = self.cspad._gain_mask_factor
+        self.nominal_gain_val = calib["gain_val"]
         self.populate_events()
         self.n_images = len(self.times)
         self.params = FormatXTCD9114.get_params(image_file)
         self._set_pppg_args()
+        self._set_pppg_plan()
+        self._set_corrector()
         self._set_psf()
-        self._set_2d_img_info()
+        self._img2d_mask = None  # made on first use, see _set_2d_img_info
+        self._asic_slices = None  # made on first use, see _set_asic_layout, as it reads an event
         self.detector_distance = env_distance(self.params.detector_address[0],
                                               self._ds.env(), self.params.cspad.detz_offset)
         # self.feespec = psana.Detector("FeeSpec-bin")
@@ -85,11 +233,76 @@ class FormatXTCD9114(FormatXTCCspad):
     def get_num_images(self):
         return len(self.times)
 
+    def _disk_cache_file(self, kind):
+        """:return: path of the disk cache file of kind for the run, see disk_cache_file"""
+        if not self.params.d9114.disk_cache:
+            return None
+        with self._psana_lock:
+            return disk_cache_file(self.params, self.run_number, kind, self._ds.env())
+
+    def _load_calibration(self):
+        """
+        :return: dict of the pedestal, gain map, nominal gain and geometry (psf) of the run,
+            from the calibration disk cache file if there is one, otherwise from the
+            calibration store, and then written to the disk cache file
+        """
+        fname = self._disk_cache_file("calib")
+        if fname is not None and os.path.exists(fname):
+            calib = load_calibration_file(fname)
+        else:
+            with self._psana_lock:
+                calib = read_calibration(self.cspad, self.run_number)
+            if fname is not None:
+                write_calibration_file(fname, calib)
+        for name in ["dark", "gain"]:
+            calib[name].setflags(write=False)
+        return calib
+
+    def populate_events(self):
+        """
+        event times of the run, from the event index disk cache file if there is one,
+        otherwise from the run, and then written to the index file.
+        In shard mode only the events of the shard are kept, self.shard_events holds
+        their indices in the run. The psana run the events are read from (self._run,
+        and run_mapping as the base class has it) is set up here too
+        """
+        if getattr(self, "_calib_cache", None) is None:
+            self.times = []  # called by the base class __init__, ours calls it once the run and shard are set
+            return
+        with self._psana_lock:
+            # the runs of a datasource can be taken only once, self._ds is our own
+            self._run = {run.run(): run for run in self._ds.runs()}[self.run_number]
+        times = cached(self._calib_cache, ("times",) + self._calib_key, self._event_times)
+        self.shard_events = list(range(self.shard_index, len(times), self.n_shards))
+        self.times = times[self.shard_index::self.n_shards]
+        self.run_mapping = {self.run_number: (0, len(self.times), self._run)}
+        self._last_event = None, None  # index, psana event of the last event fetched
+
+    def _event_times(self):
+        fname = self._disk_cache_file("events")
+        if fname is not None and os.path.exists(fname):
+            return load_event_index(fname)
+        with self._psana_lock:
+            times = list(self._run.times())
+        if fname is not None:
+            write_event_index(fname, times)
+        return times
+
     def _set_2d_img_info(self):
-        dummie_event = self._get_event(0)
-        self.img2d_mask = self.cspad.image(dummie_event, self.cspad_mask )\
-            .astype(int).astype(bool)
-        self.img_sh = self.img2d_mask.shape
+        with self._psana_lock:
+            dummie_event = self._get_event(0)
+            self._img2d_mask = self.cspad.image(dummie_event, self.cspad_mask )\
+                .astype(int).astype(bool)
+
+    @property
+    def img2d_mask(self):
+        if self._img2d_mask is None:
+            self._set_2d_img_info()
+        return self._img2d_mask
+
+    @property
+    def img_sh(self):
+        return self.img2d_mask.shape
 
     def show_data(self, index, **kwargs):
         """
@@ -97,8 +310,9 @@ class FormatXTCD9114(FormatXTCCspad):
         :param index:
         :return:
         """
-        data = self.get_psana_data(index)* self.cspad_mask
-        self.img2d = self.cspad.image( self.event, data)
+        data = self._corrected_data(index)* self.cspad_mask
+        with self._psana_lock:
+            self.img2d = self.cspad.image( self.event, data)
         if CAN_PLOT:
             plt.figure()
             plt.imshow(self.img2d, **kwargs)
@@ -123,56 +337,218 @@ class FormatXTCD9114(FormatXTCCspad):
                             "inplace": True, "plot_details": False, "verbose": False,
                             "plot_metric": False}
 
+    def _set_pppg_plan(self):
+        """
+        the gain map and mask are fixed for the run, so the
+        pppg pixel indices, bins and smoothing kernel are made once
+        """
+        key = ("pppg_plan", str(sorted(self.pppg_args.items())),
+               self.params.d9114.pppg_subsample_fraction) + self._calib_key
+        self.pppg_plan = cached(self._calib_cache, key, lambda: PPPGPlan.from_pppg_args(
+            self.gain, self.cspad_mask, self.pppg_args).subsample(self.params.d9114.pppg_subsample_fraction))
+
+    def _set_corrector(self):
+        """dark and gain correction with a reused float64 output buffer"""
+        if self.params.d9114.common_mode_algo == "xcorr":
+            common_mode = TemplateCommonMode(self.pppg_plan, self.params.d9114.xcorr_template_shots)
+        elif self.params.d9114.common_mode_algo == "pppg_warm":
+            common_mode = WarmStartCommonMode(self.pppg_plan, self.params.d9114.warm_start_half_width)
+        else:
+            common_mode = self.pppg_plan
+        shift_cache = None
+        if self.params.d9114.shift_cache is not None:
+            fingerprint = plan_fingerprint(self.pppg_plan, self.params.d9114.common_mode_algo,
+                                           dark=self.dark)
+            fingerprint["run"] = self.run_number
+            path = self.params.d9114.shift_cache
+            if self.n_shards > 1:  # one writer per sidecar
+                path += ".shard%d" % self.shard_index
+            shift_cache = ShiftCache(path, fingerprint)
+            if not shift_cache.enabled:
+                shift_cache = None
+        gain_corrector = None
+        if self.params.d9114.gain_corrector is not None:
+            from cxid9114.gain_utils import GainCorrector
+            path = self.params.d9114.gain_corrector
+            gain_corrector = cached(calibration_cache(path), "gain_corrector",
+                                    lambda: GainCorrector.load(path))
+        self.corrector = FrameCorrector(self.dark, self.gain, self.cspad_mask, self.nominal_gain_val,
+                                        plan=common_mode, dtype=np.float64, apply_mask=False,
+                                        shift_cache=shift_cache, gain_corrector=gain_corrector)
+        self.frame_cache = FrameCache(self.params.d9114.frame_cache_mbytes)
+        self._pipeline = None
+        self._pipeline_next = None  # index the pipeline returns next
+        self._event_index = None  # index of the last read, see event
+
     @staticmethod
     def get_params(image_file):
-        user_scope = phil.parse(file_name=image_file, process_includes=True)
-        params = d9114_locator_scope.fetch(user_scope).extract()
-        return params
+        """locator params, the file is parsed once per process unless it changes"""
+        path = os.path.abspath(image_file)
+        key = (path, os.path.getmtime(path))
+        if key not in _PARAMS_CACHE:
+            user_scope = phil.parse(file_name=image_file, process_includes=True)
+            _PARAMS_CACHE[key] = d9114_locator_scope.fetch(user_scope)
+        return _PARAMS_CACHE[key].extract()
 
     @staticmethod
     def understand(image_file):
         params = FormatXTCD9114.get_params(image_file)
         return params.experiment == "cxid9114" and \
-               params.d9114.common_mode_algo in ['default', 'pppg', 'unbonded']
+               params.d9114.common_mode_algo in ['default', 'pppg', 'pppg_warm', 'xcorr', 'unbonded']
 
     def get_psana_raw(self, index=None):
-        return self.cspad.raw(self._get_event(index))
+        return self._read_event(index)[1]
+
+    def _get_event(self, index):
+        """psana event of index, the last one fetched is kept as fetching is slow"""
+        if index is None:
+            index = 0
+        with self._psana_lock:
+            last, event = self._last_event
+            if index != last:
+                event = self._run.event(self.times[index])
+                self._last_event = index, event
+            return event
+
+    def get_detector(self, index=None):
+        with self._psana_lock:
+            return FormatXTCCspad.get_detector(self, index)
 
     def get_psana_data( self, index):
-        self.event = self._get_event(index)
-        raw = self.cspad.raw(self.event).astype(np.float32)
-        data = raw.astype(np.float64) - self.dark
+        """corrected data, a new array owned by the caller"""
+        return self._corrected_data(index).copy()
+
+    def _corrected_data(self, index):
+        """
+        corrected data, written to the correctors buffer which is
+        overwritten by the next call, or the cached frame if the
+        event was corrected before (do not modify either)
+        """
+        self._event_index = index
+        frame = self.frame_cache.get(index)
+        if frame is not None:
+            if self._pipeline is not None and index == self._pipeline_next:
+                try:
+                    self._pipeline.get()  # skipped by the pipeline, unless it was cached after being read
+                    self._pipeline_next = index + 1
+                except Exception:
+                    self.stop_prefetch()
+            return frame
+        if self.params.d9114.prefetch_depth > 0:
+            event, data = self._get_prefetched(index)
+        else:
+            event, raw = self._read_event(index)
+            data = self._correct_event(index, raw)
+        self._last_event = index, event
+        self.frame_cache.put(index, data)
+
+        return data
+
+    @property
+    def event(self):
+        """psana event of the last index read, fetched on access if its data came from the frame cache"""
+        index, event = self._last_event
+        if index != self._event_index and self._event_index is not None:
+            event = self._get_event(self._event_index)
+            self._last_event = self._event_index, event
+        return event
+
+    def _read_event(self, index):
+        """:return: the psana event and its raw cspad data"""
+        with self._psana_lock:
+            event = self._get_event(index)
+            return event, self.cspad.raw(event)
+
+    def _correct_event(self, index, raw, out=None):
+        """
+        :param out: output array, defaults to the correctors buffer
+        :return: out, the corrected data
+        """
+        data = self.corrector.subtract_dark(raw, out)
         if self.params.d9114.common_mode_algo == 'default':
-            self.cspad.common_mode_apply(self.run_number, data, (1, 25, 25, 100, 1))  # default for cspad
+            with self._psana_lock:
+                self.cspad.common_mode_apply(self.run_number, data, (1, 25, 25, 100, 1))  # default for cspad
         elif self.params.d9114.common_mode_algo == 'unbonded':
-            self.cspad.common_mode_apply(self.run_number, data, (
-                5, 0, 0, 0, 0))  # default for non-bonded pixels, but these are not in cxid9114 i believe..
-        elif self.params.d9114.common_mode_algo == "pppg":
-            pppg(data, self.gain, self.cspad_mask, **self.pppg_args)
-
-        data[self.gain] = data[self.gain] * self.nominal_gain_val
+            with self._psana_lock:
+                self.cspad.common_mode_apply(self.run_number, data, (
+                    5, 0, 0, 0, 0))  # default for non-bonded pixels, but these are not in cxid9114 i believe..
+        elif self.params.d9114.common_mode_algo in ["pppg", "pppg_warm", "xcorr"]:
+            self.corrector.common_mode(data, key=self.shard_events[index])  # shift cache is per run
 
+        self.corrector.apply_gain(data)
         return data
 
+    def _get_prefetched(self, index):
+        """
+        event and corrected data of index from the prefetch pipeline, which is
+        restarted at index unless index is the next event of the current one.
+        The pipeline skips events in the frame cache, and is stopped by an error,
+        so that the next call retries
+        :return: the psana event and its corrected data
+        """
+        if self._pipeline is None or index != self._pipeline_next:
+            self.stop_prefetch()
+            self._pipeline = EventPipeline(
+                self._read_event,
+                lambda i, event_raw: (event_raw[0], self._correct_event(
+                    i, event_raw[1], out=np.empty(self.dark.shape, np.float64))),
+                range(index, self.get_num_images()),
+                depth=self.params.d9114.prefetch_depth,
+                skip=self.frame_cache.__contains__)
+        try:
+            _, item = self._pipeline.get()
+        except Exception:
+            self.stop_prefetch()
+            raise
+        self._pipeline_next = index + 1
+        if item is None:  # skipped as it was cached, but evicted since
+            self.stop_prefetch()  # the corrector is not shared with the pipeline threads
+            event, raw = self._read_event(index)
+            return event, self._correct_event(index, raw)
+        return item
+
+    def stop_prefetch(self):
+        """stops the background threads of the prefetch pipeline"""
+        if self._pipeline is not None:
+            self._pipeline.close()
+            self._pipeline = None
+
     def _set_psf(self):
-        geom = self.cspad.geometry(self.run_number)
-        self.psf = map(np.array, zip(*geom.get_psf()))
+        self.psf = cached(self._calib_cache, ("calib",) + self._calib_key, self._load_calibration)["psf"]
 
-    def get_raw_data(self, index):
-        """this is really corrected data..."""
-        data = self.get_psana_data(index)
-        assert(data.dtype == np.float64)
+    def _set_asic_layout(self, index):
+        """
+        slices of the 32 x 185 x 388 data holding each asic, in the order of the
+        detector panels, the detector is the same for all events of the run
+        :param index: event the detector is taken from, e.g. the one being read
+        """
         cctbx_det = self.get_detector(index)
-        self._raw_data = []
+        asic_slices = []
         for quad_count, quad in enumerate(cctbx_det.hierarchy()):
             for sensor_count, sensor in enumerate(quad):
                 for asic_count, asic in enumerate(sensor):
                     fdim, sdim = asic.get_image_size()
-                    asic_data = data[sensor_count + quad_count * 8, :,
-                                asic_count * fdim:(asic_count + 1) * fdim]  # 8 sensors per quad
-                    self._raw_data.append(flex.double(np.array(asic_data)))
+                    asic_slices.append(np.s_[sensor_count + quad_count * 8, :,
+                                       asic_count * fdim:(asic_count + 1) * fdim])  # 8 sensors per quad
+        # the usual cspad layout, two 194 pixel wide asics per panel, is split in one copy
+        self._aaron64 = asic_slices == \
+            [np.s_[i // 2, :, (i % 2) * 194:(i % 2 + 1) * 194] for i in range(64)]
+        self._asic_buffer = np.empty((64, 185, 194), np.float64)
+        self._asic_slices = asic_slices
 
-        return tuple(self._raw_data)
+    def get_raw_data(self, index):
+        """this is really corrected data..."""
+        data = self._corrected_data(index)
+        assert(data.dtype == np.float64)
+        if self._asic_slices is None:
+            self._set_asic_layout(index)
+        if self._aaron64:
+            self._raw_data = geom_utils.psana_data_to_aaron64_data(data, as_flex=True,
+                                                                   buffer=self._asic_buffer)
+        else:
+            self._raw_data = tuple(flex.double(np.ascontiguousarray(data[asic_slice]))
+                                   for asic_slice in self._asic_slices)
+        return self._raw_data
         #data2d = self.cspad.image(self.event, data)
         #return flex.double( data2d*self.img2d_mask)
 
@@ -0,0 +1,574 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import copy
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from multiprocessing.sharedctypes import RawArray
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+import h5py
+import numpy as np
+
+from cxid9114.common_mode.pppg import PPPGPlan
+
+
+class FrameCorrector(object):
+    """
+    Fused dark, common mode and gain correction of raw cspad frames.
+    The calibration arrays are converted to the working dtype once, and the
+    mask and gain factor are folded into a single per-pixel scale, so that a
+    raw int16 frame is corrected into a preallocated buffer with no
+    full-frame temporaries.
+    """
+    def __init__(self, dark, gain, mask, gain_val, plan=None, pppg_args=None,
+                 dtype=np.float32, apply_mask=True, shift_cache=None, pixel_gain=None,
+                 gain_corrector=None):
+        """
+        :param dark: 32 x 185 x 388 pedestal
+        :param gain: 32 x 185 x 388 boolean gain map, True for low gain pixels
+        :param mask: 32 x 185 x 388 boolean mask, False for pixels to ignore
+        :param gain_val: factor applied to low gain pixels
+        :param plan: PPPGPlan for common mode, or any estimator with the same shifts and
+            subtract methods (e.g. TemplateCommonMode), made from gain, mask and pppg_args if None
+        :param pppg_args: dict of pppg parameters, used if plan is None
+        :param dtype: working dtype, np.float32 or np.float64
+        :param apply_mask: whether to zero the masked pixels of the output
+        :param shift_cache: ShiftCache, common mode shifts of shots with a key are
+            read from it if present, otherwise computed and stored
+        :param pixel_gain: 32 x 185 x 388 per-pixel gain map (see pixel_gain.py), used
+            in place of gain_val
+        :param gain_corrector: gain_utils.GainCorrector, used in place of gain_val, its low
+            gain pixels above the photon cutoff are scaled by its gain, the others by its bg_gain
+        """
+        self.dtype = np.dtype(dtype)
+        self.dark = np.ascontiguousarray(dark, dtype=self.dtype)
+        gain = np.asarray(gain, dtype=bool)
+        if plan is None and pppg_args is not None:
+            plan = PPPGPlan.from_pppg_args(gain, mask, pppg_args)
+        self.plan = plan
+        self.shift_cache = shift_cache
+        # applied after common mode, zeroes masked pixels and scales the low gain pixels
+        self.gain_corrector = gain_corrector
+        if gain_corrector is not None:
+            if pixel_gain is not None:
+                raise ValueError("pixel_gain and gain_corrector both replace gain_val, give one")
+            scale = np.array(gain_corrector.base_mult, dtype=np.float64)
+            self.photon_ratio = gain_corrector.photon_ratio.astype(self.dtype)
+            self._photons = np.empty(self.dark.shape, bool)
+        elif pixel_gain is not None:
+            scale = np.array(pixel_gain, dtype=np.float64)
+        else:
+            scale = np.where(gain, gain_val, 1.)
+        if apply_mask:
+            scale *= mask
+        self.scale = scale.astype(self.dtype)
+        self.buffer = np.empty(self.dark.shape, self.dtype)
+
+        self.n_frames = 0
+        self.total_time = 0.
+        self.max_time = 0.
+
+    def subtract_dark(self, raw, out=None):
+        """
+        :param raw: raw frame, any dtype (usually int16)
+        :param out: output array, defaults to the preallocated buffer
+        :return: out, the dark subtracted frame
+        """
+        if out is None:
+            out = self.buffer
+        np.subtract(raw, self.dark, out=out, casting='unsafe')
+        return out
+
+    def common_mode(self, data, key=None):
+        """
+        applies pppg common mode to data, in place
+        :param key: shot index, used to look up and store the shifts in the shift cache
+        """
+        if self.plan is None:
+            return
+        shifts = None
+        if self.shift_cache is not None and key is not None:
+            shifts = self.shift_cache.get(key)
+            if shifts is None:
+                shifts = self.plan.shifts(data)
+                self.shift_cache.put(key, *shifts)
+        if shifts is None:
+            shifts = self.plan.shifts(data)
+        self.plan.subtract(data, *shifts)
+
+    def apply_gain(self, data):
+        """applies the mask and gain factor to data, in place"""
+        if self.gain_corrector is not None:
+            np.greater(data, self.gain_corrector.cutoff, out=self._photons)
+        np.multiply(data, self.scale, out=data)
+        if self.gain_corrector is not None:
+            np.multiply(data, self.photon_ratio, out=data, where=self._photons)
+
+    def correct(self, raw, out=None, key=None):
+        """
+        dark subtraction, common mode and gain correction, in that order
+        :param raw: raw frame, any dtype (usually int16)
+        :param out: output array, defaults to the preallocated buffer, which
+            is overwritten by the next call to correct
+        :param key: shot index, for the shift cache
+        :return: out, the corrected frame
+        """
+        t = time.time()
+        out = self.subtract_dark(raw, out)
+        self.common_mode(out, key)
+        self.apply_gain(out)
+        t = time.time() - t
+        self.n_frames += 1
+        self.total_time += t
+        self.max_time = max(self.max_time, t)
+        return out
+
+    def report(self):
+        """
+        :return: dict of per-frame timing and memory use
+        """
+        info = {"n_frames": self.n_frames,
+                "mean_time_per_frame": self.total_time / max(self.n_frames, 1),
+                "max_time_per_frame": self.max_time,
+                "calib_mbytes": (self.dark.nbytes + self.scale.nbytes) / 1e6,
+                "buffer_mbytes": self.buffer.nbytes / 1e6}
+        if HAS_RESOURCE:
+            info["peak_rss_mbytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3  # ru_maxrss is in kB
+        return info
+
+
+def _shared_copy(arr):
+    """:return: shared memory buffer holding a copy of arr, and an array view of it"""
+    buff = RawArray('b', arr.nbytes)
+    view = np.frombuffer(buff, dtype=arr.dtype).reshape(arr.shape)
+    view[:] = arr
+    return buff, view
+
+
+# set in each CorrectionPool worker process by _pool_init
+_POOL = {}
+
+
+def _pool_init(corrector, shape, dark_buff, scale_buff, raw_buff, out_buff, raw_dtype, nslots):
+    """pool initializer, the corrector views the shared calibration without copying it"""
+    corrector.dark = np.frombuffer(dark_buff, dtype=corrector.dtype).reshape(shape)
+    corrector.scale = np.frombuffer(scale_buff, dtype=corrector.dtype).reshape(shape)
+    corrector.buffer = np.empty(shape, corrector.dtype)
+    _POOL['corrector'] = corrector
+    _POOL['raw'] = np.frombuffer(raw_buff, dtype=raw_dtype).reshape((nslots,) + shape)
+    _POOL['out'] = np.frombuffer(out_buff, dtype=corrector.dtype).reshape((nslots,) + shape)
+
+
+def _pool_correct(slot):
+    """corrects the raw frame of slot into the output frame of slot"""
+    _POOL['corrector'].correct(_POOL['raw'][slot], out=_POOL['out'][slot])
+
+
+class CorrectionPool(object):
+    """
+    FrameCorrector.correct in a pool of worker processes.
+    The dark and scale arrays of the corrector are copied once into shared
+    memory, and raw and corrected frames pass through a ring of shared memory
+    slots, so neither calibration nor frames are ever pickled.
+    The common mode estimator must be a stateless PPPGPlan (or None): the state of
+    estimators such as TemplateCommonMode or WarmStartCommonMode would depend on which
+    worker got which frame. A shift cache is refused too, as workers cannot share its file.
+    Close the pool, or use it as a context manager, to stop the workers.
+    """
+    def __init__(self, corrector, raw_dtype=np.int16, nproc=None, nslots=None):
+        """
+        :param corrector: FrameCorrector
+        :param raw_dtype: dtype of the raw frames
+        :param nproc: number of workers, defaults to the number of cpus
+        :param nslots: number of frames in flight, defaults to 2*nproc
+        """
+        if corrector.plan is not None and not isinstance(corrector.plan, PPPGPlan):
+            raise ValueError("CorrectionPool needs a stateless common mode, a PPPGPlan, not %s"
+                             % type(corrector.plan).__name__)
+        if corrector.shift_cache is not None:
+            raise ValueError("CorrectionPool cannot use a shift cache")
+        self.pool = None
+        if nproc is None:
+            nproc = multiprocessing.cpu_count()
+        if nslots is None:
+            nslots = 2*nproc
+        self.nslots = nslots
+        shape = corrector.dark.shape
+        raw_dtype = np.dtype(raw_dtype)
+        dark_buff, _ = _shared_copy(corrector.dark)
+        scale_buff, _ = _shared_copy(corrector.scale)
+        raw_buff, self.raw = _shared_copy(np.zeros((nslots,) + shape, raw_dtype))
+        out_buff, self.out = _shared_copy(np.zeros((nslots,) + shape, corrector.dtype))
+
+        worker = copy.copy(corrector)  # the arrays are replaced by the shared ones in each worker
+        worker.dark = worker.scale = worker.buffer = None
+        self.pool = multiprocessing.Pool(nproc, initializer=_pool_init,
+                                         initargs=(worker, shape, dark_buff, scale_buff, raw_buff,
+                                                   out_buff, raw_dtype, nslots))
+
+    def correct_iter(self, frames):
+        """
+        :param frames: iterable of key, raw frame
+        :return: generator of key, corrected frame, in the order of frames. The corrected
+            frame is a shared slot, overwritten once the next frame is requested
+        """
+        pending = deque()
+        slot = 0
+        try:
+            for key, raw in frames:
+                if len(pending) == self.nslots:
+                    done_key, slot, result = pending.popleft()
+                    result.get()
+                    yield done_key, self.out[slot]
+                else:
+                    slot = len(pending)
+                self.raw[slot] = raw
+                pending.append((key, slot, self.pool.apply_async(_pool_correct, (slot,))))
+            while pending:
+                done_key, slot, result = pending.popleft()
+                result.get()
+                yield done_key, self.out[slot]
+        finally:
+            for _, _, result in pending:  # the slots are reused by the next call
+                result.wait()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, "pool", None) is not None:
+            self.pool.terminate()
+
+
+class EventPipeline(object):
+    """
+    Reads and corrects the events of indices ahead of the caller, in two background
+    threads connected by queues of at most depth events: a reader calling read(index)
+    and a corrector calling correct(index, item) on each item read.
+    """
+    _done = object()
+
+    def __init__(self, read, correct, indices, depth=4, skip=None):
+        """
+        :param read: function of the event index, returns the raw event
+        :param correct: function of the event index and the raw event, returns the
+            corrected event, in a new array as the caller may hold several events
+        :param indices: event indices, in the order they will be requested
+        :param depth: events held by each queue
+        :param skip: function of the event index, True for events the caller already
+            has (e.g. cached), these are neither read nor corrected, get returns index, None
+        """
+        self.read = read
+        self.correct = correct
+        self.skip = skip
+        self.indices = list(indices)
+        self._raw = queue.Queue(maxsize=depth)
+        self._corrected = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._read_stage),
+                         threading.Thread(target=self._correct_stage)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, q, item):
+        """puts item on q unless the pipeline is closed, :return: whether it was put"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """:return: the next item of q, or the done marker if the pipeline is closed"""
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        return self._done
+
+    def _read_stage(self):
+        try:
+            for index in self.indices:
+                if self.skip is not None and self.skip(index):
+                    item = index, None
+                else:
+                    item = index, self.read(index)
+                if not self._put(self._raw, item):
+                    return
+        except Exception as err:
+            self._put(self._raw, err)
+            return
+        self._put(self._raw, self._done)
+
+    def _correct_stage(self):
+        while True:
+            item = self._get(self._raw)
+            if item is not self._done and not isinstance(item, Exception):
+                index, raw = item
+                try:
+                    if raw is not None:
+                        item = index, self.correct(index, raw)
+                except Exception as err:
+                    item = err
+            if not self._put(self._corrected, item) or item is self._done \
+                    or isinstance(item, Exception):
+                return
+
+    def get(self):
+        """
+        :return: index, corrected event of the next index, or None after the last one.
+            An error of the stages is raised once, the pipeline is then done
+        """
+        item = self._corrected.get()
+        if item is self._done or isinstance(item, Exception):
+            self._corrected.put(self._done)  # the stages have stopped, later calls get None
+            if item is self._done:
+                return None
+            raise item
+        return item
+
+    def close(self):
+        """stops and joins the background threads"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+class FrameCache(object):
+    """
+    Least recently used cache of corrected frames, bounded by a memory budget.
+    Frames are copied in, since the corrector buffer is reused.
+    """
+    def __init__(self, max_mbytes=200.):
+        """
+        :param max_mbytes: memory budget of the cached frames, 0 disables the cache
+        """
+        self.max_bytes = max_mbytes * 1e6
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: the cached frame, or None. The frame is owned by the cache, do not modify it
+        """
+        frame = self._frames.pop(key, None)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._frames[key] = frame  # most recently used
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        """caches a copy of frame, evicting the least recently used frames beyond the budget"""
+        if frame.nbytes > self.max_bytes:
+            return
+        if key in self._frames:
+            self.nbytes -= self._frames.pop(key).nbytes
+        self._frames[key] = frame.copy()
+        self.nbytes += frame.nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._frames.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def report(self):
+        """
+        :return: dict of the cache use
+        """
+        return {"n_frames": len(self), "mbytes": self.nbytes / 1e6,
+                "hits": self.hits, "misses": self.misses}
+
+
+def calibration_fingerprint(arrays, params):
+    """
+    :param arrays: list of calibration arrays, e.g. pedestal, gain and mask
+    :param params: dict of correction parameters
+    :return: hex digest identifying the correction
+    """
+    h = hashlib.sha1()
+    for arr in arrays:
+        if arr is None:
+            h.update(b"None")
+            continue
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(arr.tobytes())
+    h.update(str(sorted((str(k), str(v)) for k, v in params.items())).encode())
+    return h.hexdigest()
+
+
+# calibration arrays and models shared by all format instances of a process,
+# one dict per (path, mtime) of the source file, for the most recently used files
+CALIB_CACHE_FILES = 8
+_CALIB_CACHE = OrderedDict()
+
+
+def calibration_cache(image_file):
+    """
+    :param image_file: path of the hit file or locator the calibration is read from
+    :return: dict of the cached calibration of image_file, entries made from an
+        older version of the file are dropped, as are those of the least recently used
+        files beyond CALIB_CACHE_FILES. Cached arrays are shared, do not modify them
+    """
+    path = os.path.abspath(image_file)
+    key = (path, os.path.getmtime(path))
+    entry = _CALIB_CACHE.pop(key, None)
+    if entry is None:
+        for old in [k for k in _CALIB_CACHE if k[0] == path]:
+            del _CALIB_CACHE[old]
+        entry = {}
+    _CALIB_CACHE[key] = entry  # most recently used
+    while len(_CALIB_CACHE) > CALIB_CACHE_FILES:
+        _CALIB_CACHE.popitem(last=False)
+    return entry
+
+
+def clear_calibration_cache():
+    """drops the cached calibration of all files, instances keep what they already hold"""
+    _CALIB_CACHE.clear()
+
+
+def cached(cache, key, make):
+    """
+    :param cache: dict from calibration_cache
+    :param key: hashable key of the entry
+    :param make: function computing the entry if it is missing, arrays it returns are made read-only
+    :return: the cached entry
+    """
+    if key not in cache:
+        value = make()
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+        cache[key] = value
+    return cache[key]
+
+
+class CorrectedFrameStore(object):
+    """
+    HDF5 sidecar of corrected frames, stored as float32 with one chunk per frame.
+    Frames are written the first time they are corrected and read back on later runs.
+    The sidecar is cleared if the fingerprint of the correction
+    (see calibration_fingerprint) does not match.
+    Only the process that opened the sidecar for writing writes to it. If it cannot be
+    opened for writing (read-only directory, or held by another process) it is read
+    only, and if it cannot be read either, or is stale and read-only, the store is off.
+    """
+    def __init__(self, filename, n_frames, frame_shape, fingerprint, source=""):
+        """
+        :param filename: path to the sidecar file, created if it doesnt exist
+        :param n_frames: number of frames in the source file
+        :param frame_shape: shape of one corrected frame
+        :param fingerprint: hex digest of the correction
+        :param source: path of the file the frames come from
+        """
+        self.filename = filename
+        self._pid = os.getpid()
+        self._h5, self.writable = self._open(filename)
+        shape = (n_frames,) + tuple(frame_shape)
+        if self._h5 is not None and (self._h5.attrs.get("fingerprint") != fingerprint or
+                                     "frames" not in self._h5 or self._h5["frames"].shape != shape):
+            if self.writable:
+                for name in ("frames", "stored"):
+                    if name in self._h5:
+                        del self._h5[name]
+                self._h5.create_dataset("frames", shape=shape, dtype=np.float32,
+                                        chunks=(1,) + tuple(frame_shape))
+                self._h5.create_dataset("stored", shape=(n_frames,), dtype=bool)
+                self._h5.attrs["fingerprint"] = fingerprint
+                self._h5.attrs["source"] = source
+            else:  # stale frames of another correction
+                self._h5.close()
+                self._h5 = None
+        if self._h5 is None:
+            self._frames = None
+            self._stored = np.zeros(n_frames, bool)
+        else:
+            self._frames = self._h5["frames"]
+            self._stored = self._h5["stored"][()]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _open(filename):
+        """:return: the sidecar file and whether it is writable, the file is None if it cannot be opened"""
+        for mode in ('a', 'r'):
+            try:
+                return h5py.File(filename, mode), mode == 'a'
+            except (IOError, OSError):
+                pass
+        return None, False
+
+    @property
+    def enabled(self):
+        return self._h5 is not None
+
+    def get(self, index, out):
+        """
+        :param index: frame index
+        :param out: array the frame is read into, converted to its dtype
+        :return: out, or None if the frame is not stored
+        """
+        if not self._stored[index]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.read_direct(out, np.s_[index])
+        return out
+
+    def put(self, index, frame):
+        """stores the corrected frame index, if this is the process writing the sidecar"""
+        if not self.writable or os.getpid() != self._pid:
+            return
+        try:
+            self._frames[index] = frame.astype(np.float32)
+            self._h5["stored"][index] = True
+            self._h5.flush()
+        except (IOError, OSError):
+            self.writable = False
+            return
+        self._stored[index] = True
+
+    def __contains__(self, index):
+        return bool(self._stored[index])
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+            self.writable = False
+            self._stored[:] = False
@@ -0,0 +1,99 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import multiprocessing
+try:
+    from mpi4py import MPI
+    HAS_MPI = True
+except ImportError:
+    HAS_MPI = False
+import psana
+
+from dxtbx.format.FormatXTC import FormatXTC
+from cxid9114.format.FormatXTCD9114 import FormatXTCD9114, disk_cache_file, read_calibration, \
+    write_calibration_file, write_event_index
+
+
+def mpi_rank_size():
+    """:return: rank of this process and number of ranks, 0, 1 if not under MPI"""
+    if not HAS_MPI:
+        return 0, 1
+    return MPI.COMM_WORLD.Get_rank(), MPI.COMM_WORLD.Get_size()
+
+
+def _check_disk_cache(params):
+    if not params.d9114.disk_cache:
+        raise ValueError("sharding needs d9114.disk_cache = True, or every shard walks the run")
+
+
+def write_disk_cache(locator):
+    """
+    writes the event index and calibration disk cache files of the run, if missing,
+    without setting up a full FormatXTCD9114
+    :param locator: XTC locator file of the run, with d9114.disk_cache on
+    """
+    params = FormatXTCD9114.get_params(locator)
+    _check_disk_cache(params)
+    run_number = params.run[0]
+    ds = FormatXTC._get_datasource(locator, params)
+    fname = disk_cache_file(params, run_number, "events", ds.env())
+    if not os.path.exists(fname):
+        run = {run.run(): run for run in ds.runs()}[run_number]
+        write_event_index(fname, list(run.times()))
+    fname = disk_cache_file(params, run_number, "calib", ds.env())
+    if not os.path.exists(fname):
+        write_calibration_file(fname, read_calibration(psana.Detector(params.detector_address[0]),
+                                                       run_number))
+
+
+def _run_shard(args):
+    locator, shard_index, n_shards, worker = args
+    loader = FormatXTCD9114(locator, shard_index=shard_index, n_shards=n_shards)
+    return worker(loader)
+
+
+def run_shards(locator, worker, n_shards=None, merge=None, use_mpi=True):
+    """
+    runs worker on every shard of the events of a run, one process per shard.
+    Under mpirun with more than one rank each rank is a shard, otherwise the
+    shards run in a process pool. Sharding needs d9114.disk_cache on: the event
+    index and calibration are written to the disk cache once, before the shards
+    start, so they are not read from the run by every worker
+    :param locator: XTC locator file of the run
+    :param worker: function of the FormatXTCD9114 of a shard (loader.times and
+        loader.shard_events are the shard's events), returns the shard's output.
+        It must be picklable, e.g. a module level function or a functools.partial of one
+    :param n_shards: number of pool processes, defaults to the number of cpus, ignored under MPI
+    :param merge: function of the list of shard outputs, in shard order
+    :param use_mpi: use MPI when mpi4py is available and there is more than one rank,
+        False with more than one rank raises, as each rank would run every shard
+    :return: merge(outputs), or the list of outputs if merge is None. Under MPI, ranks other than 0 return None
+    """
+    _check_disk_cache(FormatXTCD9114.get_params(locator))  # on every rank, before any waits for rank 0
+    rank, size = mpi_rank_size()
+    if size > 1:
+        if not use_mpi:
+            raise ValueError("run_shards with use_mpi=False under mpirun would run every shard on every rank")
+        comm = MPI.COMM_WORLD
+        if rank == 0:
+            write_disk_cache(locator)
+        comm.Barrier()
+        output = _run_shard((locator, rank, size, worker))
+        outputs = comm.gather(output, root=0)
+        if rank != 0:
+            return None
+    else:
+        if n_shards is None:
+            n_shards = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_shards)
+        try:
+            pool.apply(write_disk_cache, (locator,))  # psana is only used in the workers
+            outputs = pool.map(_run_shard, [(locator, i, n_shards, worker) for i in range(n_shards)],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if merge is None:
+        return outputs
+    return merge(outputs)
@@ -1,17 +1,69 @@
+import os
 import numpy as np
 import pylab as plt
 import lmfit
+from scipy.ndimage import convolve1d
 from cxid9114 import fit_utils, utils
 from cxid9114.mask import mask_utils
+from cxid9114.common_mode.pppg import PPPGPlan, _density
 
 
-def get_gain_dists(panel_data, gain_data, mask_data=None, plot=False, norm=False):
+def _smooth_rows(y, window_size=30, beta=10.0):
+    """utils.smooth applied to each row of y"""
+    if window_size % 2 == 0:
+        window_size += 1
+    w = np.kaiser(window_size, beta)
+    return convolve1d(y, w / w.sum(), axis=-1, mode='mirror')
+
+
+def _get_gain_dists_fast(panel_data, gain_data, mask_data):
+    """
+    get_gain_dists without the unused gaussian fits. Each histogram pass bins
+    all panels of both gain modes at once (see common_mode/pppg.py)
+    """
+    #   same bins and panels as get_gain_dists
+    plan = PPPGPlan(gain_data, mask_data, low_x1=-10, low_x2=20, Nlow=600,
+                    high_x1=-20, high_x2=50, Nhigh=400)
+    bc_low, bc_high = plan.xdata_low, plan.xdata_high
+    i1_low = np.argmin( np.abs(bc_low+10))
+    i2_low = np.argmin( np.abs(bc_low-10))
+    i1_high = np.argmin( np.abs(bc_low+20))
+    i2_high = np.argmin( np.abs(bc_low-15))
+    low_gain_idx = [0,1,7,8,9,15,16,17,23,24,25,31]
+    high_gain_idx =[0,2,3,4,5,6,7,8,10,11,12,14,15,16,
+                    18,19,20,22,23,24,26,27,28,30,31]
+
+    pixels_low, pixels_high = plan.gather(panel_data)
+    hists_low, hists_high = plan.histograms(pixels_low, pixels_high)
+    with np.errstate(invalid='ignore'):
+        ydata_low = _density(hists_low, bc_low[1]-bc_low[0])[:, i1_low:i2_low]
+        ydata_high = _density(hists_high, bc_high[1]-bc_high[0])[:, i1_high:i2_high]
+    mu_low = bc_low[i1_low:i2_low][np.argmax(_smooth_rows(ydata_low), axis=-1)]
+    mu_high = bc_high[i1_high:i2_high][np.argmax(_smooth_rows(ydata_high), axis=-1)]
+
+    panel_data2 = np.zeros_like( panel_data)
+    np.subtract(panel_data, mu_low[:, None, None], out=panel_data2, where=plan.is_low)
+    np.subtract(panel_data, mu_high[:, None, None], out=panel_data2, where=plan.is_high)
+
+    hists_low, hists_high = plan.histograms(pixels_low - mu_low[plan.pid_low],
+                                            pixels_high - mu_high[plan.pid_high])
+    low_gain_dists = _density(hists_low[low_gain_idx], bc_low[1]-bc_low[0])
+    high_gain_dists = _density(hists_high[high_gain_idx], bc_high[1]-bc_high[0])
+
+    return bc_low, np.mean(low_gain_dists,0), bc_high, np.mean(high_gain_dists,0), panel_data2
+
+
+def get_gain_dists(panel_data, gain_data, mask_data=None, plot=False, norm=False, fast=False):
     """
     this processes the panel data and applies common mode to the panels
     different gain sections individually.
+    :param fast: skip the gaussian fits, which only serve the plots, and histogram
+        all panels at once. Returns the same distributions and corrected data
     """
     if mask_data is None:
         mask_data = np.ones_like( gain_data)
+    if fast and not plot:
+        return _get_gain_dists_fast(panel_data, gain_data, mask_data)
 
     panel_data2 = np.zeros_like( panel_data)
 
@@ -114,38 +166,102 @@ def get_gain_dists(panel_data, gain_data, mask_data=None, plot=False, norm=False
 
     return bc_low, np.mean(low_gain_dists,0), bc_high, np.mean(high_gain_dists,0), panel_data2
 
-def correct_panels(data, gain_map, mask,plot=False):
-    xlow,ylow,xhigh,yhigh,new_data = get_gain_dists( data, gain_map, mask)
-
-    low_g0,low_g1,fit_low = fit_utils.fit_low_gain_dist(xlow,ylow,plot=plot)
-    high_g0,high_g1,fit_high = fit_utils.fit_high_gain_dist(xhigh,yhigh,plot=plot)
-
-    low_1phot = xlow[low_g1.argmax()]
-    #high_1phot = xhigh[high_g1.argmax()]
-    high_1phot = xhigh[np.argmax(utils.smooth(yhigh, window_size=30)[220:300]) + 220]
-    print "Low gain 1 photon peak: %.4f ADU"%low_1phot
-    print "High gain 1 photon peak: %.4f ADU"%high_1phot
-    gain = high_1phot / low_1phot
-
-    print "Estimated gain: %.4f"%gain
-
-    low_0phot_wid = fit_low.params['wid0']
-    high_0phot_wid = fit_high.params['wid0']
-    bg_gain = high_0phot_wid / low_0phot_wid
-    print "Estimated dark-current gain: %.4f"%bg_gain
-
-    cutoff = low_1phot - 1*fit_low.params['wid1'].value/np.sqrt(2.)
-    print "Estimated low-gain dark-current cutoff ADU: %.4f"%cutoff
-
-    #cutoff = 1.85
-    #gain = 6.85
-    #bg_gain = 1.95
+class GainCorrector(object):
+    """
+    Low gain correction with constants fitted once per run.
+    Low gain pixels are scaled by bg_gain, or by gain above the photon cutoff,
+    which is a single multiply with per-pixel multipliers precomputed from the gain map.
+    """
+    def __init__(self, gain_map, gain, bg_gain, cutoff):
+        """
+        :param gain_map: 32 x 185 x 388 boolean, True for low gain pixels
+        :param gain: ratio of the high to low gain 1 photon peaks
+        :param bg_gain: ratio of the high to low gain 0 photon peak widths
+        :param cutoff: low gain ADU above which a pixel holds photons
+        """
+        self.gain_map = np.asarray(gain_map, dtype=bool)
+        self.gain = float(gain)
+        self.bg_gain = float(bg_gain)
+        self.cutoff = float(cutoff)
+        self.base_mult = np.where(self.gain_map, self.bg_gain, 1.)
+        self.photon_mult = np.where(self.gain_map, self.gain, 1.)
+        # photon pixels get base_mult times photon_ratio, so correct is two in-place multiplies
+        self.photon_ratio = self.photon_mult / self.base_mult
+        self._photons = np.empty(self.gain_map.shape, bool)
+
+    @classmethod
+    def fit(cls, data, gain_map, mask, plot=False):
+        """
+        fits the gain constants to the averaged gain distributions of one shot
+        :return: the GainCorrector, and the common mode corrected data from get_gain_dists
+        """
+        xlow,ylow,xhigh,yhigh,new_data = get_gain_dists( data, gain_map, mask, fast=True)
+
+        low_g0,low_g1,fit_low = fit_utils.fit_low_gain_dist(xlow,ylow,plot=plot)
+        high_g0,high_g1,fit_high = fit_utils.fit_high_gain_dist(xhigh,yhigh,plot=plot)
+
+        low_1phot = xlow[low_g1.argmax()]
+        #high_1phot = xhigh[high_g1.argmax()]
+        high_1phot = xhigh[np.argmax(utils.smooth(yhigh, window_size=30)[220:300]) + 220]
+        print "Low gain 1 photon peak: %.4f ADU"%low_1phot
+        print "High gain 1 photon peak: %.4f ADU"%high_1phot
+        gain = high_1phot / low_1phot
+
+        print "Estimated gain: %.4f"%gain
+
+        low_0phot_wid = fit_low.params['wid0'].value
+        high_0phot_wid = fit_high.params['wid0'].value
+        bg_gain = high_0phot_wid / low_0phot_wid
+        print "Estimated dark-current gain: %.4f"%bg_gain
+
+        cutoff = low_1phot - 1*fit_low.params['wid1'].value/np.sqrt(2.)
+        print "Estimated low-gain dark-current cutoff ADU: %.4f"%cutoff
+
+        #cutoff = 1.85
+        #gain = 6.85
+        #bg_gain = 1.95
+
+        return cls(gain_map, gain, bg_gain, cutoff), new_data
+
+    def correct(self, data):
+        """
+        applies the gain correction to common mode corrected data, in place
+        (see also the gain_corrector of format/correct_utils.FrameCorrector)
+        :return: data
+        """
+        np.greater(data, self.cutoff, out=self._photons)
+        np.multiply(data, self.base_mult, out=data)
+        np.multiply(data, self.photon_ratio, out=data, where=self._photons)
+        return data
+
+    def save(self, filename, name="gain_corrector"):
+        """
+        writes the constants and gain map to group name of an hdf5 file. Use a file of
+        its own rather than a hit file, writing to a hit file invalidates its caches
+        """
+        import h5py
+        with h5py.File(filename, 'a') as h5:
+            if name in h5:
+                del h5[name]
+            group = h5.create_group(name)
+            group.attrs["gain"] = self.gain
+            group.attrs["bg_gain"] = self.bg_gain
+            group.attrs["cutoff"] = self.cutoff
+            group.create_dataset("gain_map", data=self.gain_map)
+
+    @classmethod
+    def load(cls, filename, name="gain_corrector"):
+        """reads a GainCorrector written by save"""
+        import h5py
+        with h5py.File(filename, 'r') as h5:
+            group = h5[name]
+            return cls(group["gain_map"][()], group.attrs["gain"],
+                       group.attrs["bg_gain"], group.attrs["cutoff"])
 
-    lowgain_photons = np.logical_and(new_data > cutoff, gain_map)
-    new_data[gain_map] = new_data[gain_map] * bg_gain
-    new_data[lowgain_photons] = new_data[lowgain_photons] * gain/bg_gain
 
-    return new_data
+def correct_panels(data, gain_map, mask,plot=False):
+    corrector, new_data = GainCorrector.fit(data, gain_map, mask, plot=plot)
+    return corrector.correct(new_data)
 
 def main():
     data =np.load("raw_peaks_img.npy")
@@ -157,43 +273,204 @@ def main():
     plt.imshow( new_data[0],  vmin=-10,vmax=50,cmap='gnuplot')
     plt.show()
 
-def main2():
+class GainHistogramAccumulator(object):
+    """
+    Running sum of the per-shot averaged low and high gain distributions
+    returned by get_gain_dists. Accumulators of disjoint event ranges can
+    be merged, and saved to / loaded from an npz checkpoint.
+    With keep_shots the per-shot distributions are kept as well, for
+    per-shot fits (see fit_utils.batch_fit_gauss_and_skewgauss).
+    """
+    def __init__(self, xlow, xhigh, keep_shots=False):
+        """
+        :param xlow: low gain bin centers
+        :param xhigh: high gain bin centers
+        :param keep_shots: keep each shot's distributions, not just their sum
+        """
+        self.xlow = np.asarray(xlow)
+        self.xhigh = np.asarray(xhigh)
+        self.sum_low = np.zeros(len(self.xlow))
+        self.sum_high = np.zeros(len(self.xhigh))
+        #   shots with empty panels give nan distributions, so count per bin
+        self.n_low = np.zeros(len(self.xlow), np.int64)
+        self.n_high = np.zeros(len(self.xhigh), np.int64)
+        self.n_shots = 0
+        self.events = []  # event indices that have been added
+        self.keep_shots = keep_shots
+        self.shots_low = []
+        self.shots_high = []
+
+    def add(self, ylow, yhigh, event=None):
+        """adds one shot's distributions"""
+        if self.keep_shots:
+            self.shots_low.append(np.array(ylow))
+            self.shots_high.append(np.array(yhigh))
+        good = np.isfinite(ylow)
+        self.sum_low[good] += ylow[good]
+        self.n_low += good
+        good = np.isfinite(yhigh)
+        self.sum_high[good] += yhigh[good]
+        self.n_high += good
+        self.n_shots += 1
+        if event is not None:
+            self.events.append(event)
+
+    def merge(self, other):
+        """adds the sums of another accumulator, with the same bins, to this one"""
+        assert np.array_equal(self.xlow, other.xlow) and np.array_equal(self.xhigh, other.xhigh)
+        self.sum_low += other.sum_low
+        self.sum_high += other.sum_high
+        self.n_low += other.n_low
+        self.n_high += other.n_high
+        self.n_shots += other.n_shots
+        self.events += other.events
+        if self.keep_shots:
+            assert other.keep_shots
+            self.shots_low += other.shots_low
+            self.shots_high += other.shots_high
+        return self
+
+    @property
+    def ylow(self):
+        """mean low gain distribution"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum_low / self.n_low
+
+    @property
+    def yhigh(self):
+        """mean high gain distribution"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum_high / self.n_high
+
+    def save(self, filename):
+        """
+        writes a checkpoint, to a temporary file first so a crash mid-write
+        leaves the previous checkpoint intact
+        """
+        if not filename.endswith(".npz"):
+            filename += ".npz"
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, xlow=self.xlow, xhigh=self.xhigh,
+                 sum_low=self.sum_low, sum_high=self.sum_high,
+                 n_low=self.n_low, n_high=self.n_high,
+                 n_shots=self.n_shots, events=np.array(self.events, np.int64),
+                 ylow=self.ylow, yhigh=self.yhigh, keep_shots=self.keep_shots,
+                 shots_low=np.reshape(self.shots_low, (-1, len(self.xlow))),
+                 shots_high=np.reshape(self.shots_high, (-1, len(self.xhigh))))
+        os.rename(tmp, filename)
+
+    def save_shots(self, filename):
+        """
+        writes the per-shot distributions as N x nbins stacks ylow and yhigh,
+        with the bins xlow, xhigh and the events of each row
+        """
+        assert self.keep_shots
+        np.savez(filename, ylow=np.reshape(self.shots_low, (-1, len(self.xlow))),
+                 yhigh=np.reshape(self.shots_high, (-1, len(self.xhigh))),
+                 xlow=self.xlow, xhigh=self.xhigh, events=np.array(self.events, np.int64))
+
+    @classmethod
+    def load(cls, filename):
+        """reads a checkpoint written by save"""
+        f = np.load(filename)
+        keep_shots = "keep_shots" in f and bool(f["keep_shots"])
+        acc = cls(f["xlow"], f["xhigh"], keep_shots=keep_shots)
+        acc.sum_low = f["sum_low"]
+        acc.sum_high = f["sum_high"]
+        acc.n_low = f["n_low"]
+        acc.n_high = f["n_high"]
+        acc.n_shots = int(f["n_shots"])
+        acc.events = [int(i) for i in f["events"]]
+        if keep_shots:
+            acc.shots_low = list(f["shots_low"])
+            acc.shots_high = list(f["shots_high"])
+        return acc
+
+
+def _survey_events(args):
+    """
+    gain survey of one range of events of a run, in its own process
+    :param args: exp, run, events (list of event indices), checkpoint filename, checkpoint_every,
+        keep_shots
+    :return: the checkpoint filename
+    """
     import psana
-    ds = psana.DataSource("exp=cxid9114:run=62")
-    events = ds.events()
+    exp, run_number, events, checkpoint, checkpoint_every, keep_shots = args
+    ds = psana.DataSource("exp=%s:run=%d:idx" % (exp, run_number))
+    run = ds.runs().next()
+    times = run.times()
 
     det = psana.Detector('CxiDs2.0:Cspad.0')
-    dark = det.pedestals(62)
-    gain_map = det.gain_mask(62) == 1
+    dark = det.pedestals(run_number)
+    gain_map = det.gain_mask(run_number) == 1
     mask = mask_utils.mask_small_regions(gain_map)
     mask2 = np.load("details_mask.npy")
     mask *= mask2
-    start = 0
 
-    all_ylow = []
-    all_yhigh = []
-    for i in range(1800):
-        ev = events.next()
+    acc = None
+    if os.path.exists(checkpoint):  # resume
+        acc = GainHistogramAccumulator.load(checkpoint)
+        done = set(acc.events)
+        events = [i for i in events if i not in done]
+
+    for n, i in enumerate(events):
+        ev = run.event(times[i])
         if ev is None:
             continue
-        if i < start:
-            continue
         raw = det.raw( ev)
         if raw is None:
             continue
         data = raw - dark
-        # new_data = correct_panels( data, gain_map, mask, plot=True)
-
-        xlow, ylow, xhigh, yhigh, new_data = get_gain_dists(data, gain_map, mask)
-        all_ylow.append( ylow)
-        all_yhigh.append( yhigh)
-
-        #plt.figure()
-        #plt.imshow( new_data[0],  vmin=-10,vmax=50,cmap='gnuplot')
-        #plt.show()
-        print i
-    np.savez("/home/dermen/cxid9114_data/all_shot_hists",
-            ylow=all_ylow, yhigh=all_yhigh, xlow=xlow, xhigh=xhigh)
+        xlow, ylow, xhigh, yhigh, _ = get_gain_dists(data, gain_map, mask, fast=True)
+        if acc is None:
+            acc = GainHistogramAccumulator(xlow, xhigh, keep_shots=keep_shots)
+        acc.add(ylow, yhigh, event=i)
+        if (n+1) % checkpoint_every == 0:
+            acc.save(checkpoint)
+    if acc is not None:
+        acc.save(checkpoint)
+        return checkpoint
+
+
+def gain_survey(exp, run_number, events, nproc=1, checkpoint_prefix="gain_survey", checkpoint_every=100,
+                keep_shots=False):
+    """
+    averaged gain distributions over many events of a run, each process surveys
+    a contiguous range of the events and checkpoints its accumulator to
+    <checkpoint_prefix>_<worker>.npz, rerunning resumes from the checkpoints
+    :param exp: experiment name e.g. cxid9114
+    :param run_number: run number
+    :param events: event indices to survey
+    :param nproc: number of processes
+    :param keep_shots: keep the per-shot distributions, in event order
+    :return: GainHistogramAccumulator of all events
+    """
+    import multiprocessing
+    ranges = np.array_split(np.asarray(events), nproc)
+    jobs = [(exp, run_number, list(r), "%s_%d.npz" % (checkpoint_prefix, i), checkpoint_every, keep_shots)
+            for i, r in enumerate(ranges)]
+    if nproc == 1:
+        checkpoints = map(_survey_events, jobs)
+    else:
+        pool = multiprocessing.Pool(nproc)
+        checkpoints = pool.map(_survey_events, jobs)
+        pool.close()
+        pool.join()
+
+    acc = None
+    for checkpoint in checkpoints:
+        if checkpoint is None:
+            continue
+        worker_acc = GainHistogramAccumulator.load(checkpoint)
+        acc = worker_acc if acc is None else acc.merge(worker_acc)
+    return acc
+
+
+def main2():
+    acc = gain_survey("cxid9114", 62, range(1800), nproc=1,
+                      checkpoint_prefix="/home/dermen/cxid9114_data/all_shot_hists", keep_shots=True)
+    acc.save_shots("/home/dermen/cxid9114_data/all_shot_hists")  # per-shot stacks, as before
+    acc.save("/home/dermen/cxid9114_data/all_shot_hists_mean")
 
 
 def main3():
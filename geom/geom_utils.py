@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 
 from dxtbx.model import Detector
@@ -77,22 +79,83 @@ def psana_geom_splitter(psf, returned_units='mm'):
     elif returned_units == "pixels":  # crystfel convention
         return origin_64 / 109.92, SS_64 / 109.92, FS_64 / 109.92
 
-def psana_data_to_aaron64_data(data, as_flex=False):
+def psana_data_to_aaron64_data(data, as_flex=False, buffer=None):
     """
     :param data:  32 x 185 x 388 cspad data
-    :return: 64 x 185 x 194 cspad data
+    :param buffer: 64 x 185 x 194 float64 array, reused for the as_flex conversion
+    :return: 64 x 185 x 194 cspad data, a list of views of data, or a tuple of flex
+        arrays owning copies of it if as_flex (buffer is only scratch space)
+    """
+    if not as_flex:
+        return [sub_asic for asic in data for sub_asic in (asic[:, :194], asic[:, 194:])]
+
+    # split all panels into their two asics in one copy, each asic is then contiguous;
+    # flex arrays own their storage, so each still needs its own copy
+    if buffer is None:
+        buffer = np.empty((64, 185, 194), np.float64)
+    np.copyto(buffer.reshape((32, 2, 185, 194)),
+              data.reshape((32, 185, 2, 194)).transpose((0, 2, 1, 3)))
+    return tuple(flex.double(asic) for asic in buffer)
+
+
+class PanelAssembler(object):
     """
-    asics = []
-    # check if necessary to convert to float 64
-    dtype = data.dtype
-    if as_flex and dtype != np.float64:
-        dtype = np.float64
-    for split_asic in [(asic[:, :194], asic[:, 194:]) for asic in data]:
-        for sub_asic in split_asic:  # 185x194 arrays
-            if as_flex:
-                sub_asic = np.ascontiguousarray(sub_asic, dtype=dtype)  # ensure contiguous arrays for flex
-                sub_asic = flex.double(sub_asic)  # flex data beith double
-            asics.append(sub_asic)
-    if as_flex:
-        asics = tuple(asics)
-    return asics
+    Assembles 32 x 185 x 388 panels into a 2D image, as
+    np.histogram2d(x, y, bins, weights=panels.ravel()) does,
+    with the destination image pixel of each panel pixel computed once.
+    """
+    def __init__(self, x, y, bins, dtype=np.float64):
+        """
+        :param x: panel pixel x coordinates, same size as the panels
+        :param y: panel pixel y coordinates, same size as the panels
+        :param bins: [xedges, yedges] of the image, monotonically increasing
+        :param dtype: dtype of the assembled image
+        """
+        x = np.asarray(x).ravel()
+        y = np.asarray(y).ravel()
+        idx = []
+        inside = np.ones(len(x), bool)
+        for coord, edges in ((x, bins[0]), (y, bins[1])):
+            # bin indices as in np.histogramdd, values on the last edge go in the last bin
+            i = np.searchsorted(edges, coord, side='right')
+            i[coord == edges[-1]] -= 1
+            inside &= (i > 0) & (i < len(edges))
+            idx.append(i - 1)
+        self.shape = (len(bins[0]) - 1, len(bins[1]) - 1)
+        src = np.flatnonzero(inside)
+        dest = idx[0][inside]*self.shape[1] + idx[1][inside]
+
+        # the first panel pixel landing on an image pixel is written, any others are added
+        order = np.argsort(dest, kind='mergesort')
+        dest, src = dest[order], src[order]
+        first = np.ones(len(dest), bool)
+        first[1:] = dest[1:] != dest[:-1]
+        self.dest, self.src = dest[first], src[first]
+        self.dup_src = src[~first]
+        self.dup_dest, self.dup_inv = np.unique(dest[~first], return_inverse=True)
+        self.buffer = np.zeros(self.shape, dtype)
+
+    def copy(self):
+        """:return: assembler sharing this one's pixel map, with its own buffer"""
+        other = copy.copy(self)
+        other.buffer = np.zeros_like(self.buffer)
+        return other
+
+    def assemble(self, panels, out=None):
+        """
+        :param panels: 32 x 185 x 388 panels
+        :param out: output image, defaults to the preallocated buffer, which is
+            overwritten by the next call
+        :return: the assembled image
+        """
+        if out is None:
+            out = self.buffer
+        else:
+            out[:] = 0
+        flat = panels.reshape(-1)
+        out_flat = out.reshape(-1)
+        out_flat[self.dest] = flat.take(self.src)  # the other image pixels are never written, and stay 0
+        if len(self.dup_dest):
+            out_flat[self.dup_dest] += np.bincount(self.dup_inv, weights=flat.take(self.dup_src),
+                                                   minlength=len(self.dup_dest))
+        return out
@@ -0,0 +1,253 @@
+from __future__ import print_function
+import numpy as np
+import h5py
+from scipy.ndimage import convolve1d
+
+from cxid9114.common_mode.pppg import CHUNK
+
+
+def _log_parabola(smoothed, k, bin_width):
+    """
+    gaussian through the 3 bins around k of each row of smoothed
+    :param smoothed: N x Nbins array of smoothed histograms
+    :param k: N array of bin indices, 0 < k < Nbins-1
+    :return: N arrays of the offset of the peak from bin k (ADU) and of the standard
+        deviation (ADU), nan where the bins are not concave
+    """
+    rows = np.arange(len(k))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        left = np.log(smoothed[rows, k-1])
+        mid = np.log(smoothed[rows, k])
+        right = np.log(smoothed[rows, k+1])
+        d2 = left - 2*mid + right
+        d2[~(d2 < 0)] = np.nan
+        delta = 0.5 * (left - right) / d2 * bin_width
+        sigma = bin_width / np.sqrt(-d2)
+    return delta, sigma
+
+
+def _log_parabola_wls(counts, xdata, center, half_width, allowed=None):
+    """
+    gaussian fit to each row of counts by weighted least squares of a parabola
+    through the log counts of the bins within +- half_width of center, each bin
+    weighted by its counts (the inverse variance of its log)
+    :param counts: N x Nbins array of histograms
+    :param xdata: Nbins array of bin centers (ADU)
+    :param center: N array, center of the fit window (ADU)
+    :param half_width: N array, half width of the fit window (ADU)
+    :param allowed: N x Nbins bool array of the bins that may be fit, all if None
+    :return: N arrays of the peak position and of the standard deviation (ADU),
+        nan where fewer than 3 bins have counts or the fit is not concave
+    """
+    u = xdata[None] - center[:, None]
+    with np.errstate(invalid='ignore'):
+        inside = np.abs(u) <= half_width[:, None]
+    if allowed is not None:
+        inside &= allowed
+    w = np.where(inside, counts, 0.)
+    u = np.where(inside, u, 0.)
+    y = np.log(np.maximum(counts, 1.))
+    wu = w*u
+    s1, s2 = wu.sum(-1), (wu*u).sum(-1)
+    s3, s4 = (wu*u*u).sum(-1), (wu*u*u*u).sum(-1)
+    a = np.array([[w.sum(-1), s1, s2],
+                  [s1, s2, s3],
+                  [s2, s3, s4]]).transpose(2, 0, 1)
+    b = np.array([(w*y).sum(-1), (wu*y).sum(-1), (wu*u*y).sum(-1)]).T
+    filled = (w > 0).sum(-1) >= 3
+    a[~filled] = np.eye(3)
+    coef = np.linalg.solve(a, b[..., None])[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        curv = np.where(filled & (coef[:, 2] < 0), coef[:, 2], np.nan)
+        mu = center - .5*coef[:, 1] / curv
+        sigma = np.sqrt(-.5 / curv)
+    return mu, sigma
+
+
+class PixelGainCalibrator(object):
+    """
+    Per-pixel photon gain from many shots.
+    Each shot adds one count per pixel to a memory-mapped uint16 count cube of
+    per-pixel ADU histograms (pixel major, Npixel x Nbins). The zero and one photon
+    peaks of each pixel are then located in batches of pixels on the smoothed
+    histograms, and fit with gaussians (weighted least squares parabolas through the
+    log counts) over +- fit_sigmas standard deviations of the counts around each peak.
+
+    Shots should be dark and common mode corrected and scaled by the nominal
+    gain (e.g. FrameCorrector with apply_mask=False), so that all pixels share the bins.
+    """
+    def __init__(self, cube_file, shape=(32, 185, 388), x1=-10., x2=50., nbins=150, mode='w+'):
+        """
+        :param cube_file: path of the count cube, Npixel*Nbins*2 bytes
+        :param shape: detector shape
+        :param x1: left edge of the histograms (ADU)
+        :param x2: right edge of the histograms (ADU)
+        :param nbins: number of histogram bins
+        :param mode: 'w+' to start a new cube, 'r+' to add to / fit an existing one
+        """
+        self.shape = tuple(shape)
+        self.npix = int(np.prod(self.shape))
+        self.x1, self.x2, self.nbins = float(x1), float(x2), int(nbins)
+        self.bin_width = (self.x2 - self.x1) / self.nbins
+        self.xdata = self.x1 + (np.arange(self.nbins) + .5)*self.bin_width
+        self.cube = np.memmap(cube_file, dtype=np.uint16, mode=mode, shape=(self.npix, self.nbins))
+        self._row = np.arange(self.npix, dtype=np.intp)*self.nbins
+        self.n_shots = 0
+
+    def add(self, shot):
+        """
+        adds one shot to the count cube
+        :param shot: corrected frame of the detector shape
+        """
+        if self.n_shots >= np.iinfo(np.uint16).max:
+            raise ValueError("uint16 count cube is full")
+        flat = self.cube.reshape(-1)
+        values = shot.reshape(-1)
+        scale = 1. / self.bin_width
+        for i in range(0, self.npix, CHUNK):
+            f = np.subtract(values[i:i+CHUNK], self.x1, dtype=np.float64)
+            f *= scale
+            inside = (f >= 0) & (f < self.nbins)
+            idx = f[inside].astype(np.intp)
+            idx += self._row[i:i+CHUNK][inside]
+            flat[idx] += 1  # one count per pixel, so the indices are unique
+        self.n_shots += 1
+
+    def _fit_peak(self, counts, center, sigma, fit_sigmas, n_iter, allowed=None):
+        """
+        gaussian fits to the peaks of counts starting from center and sigma, the fit
+        window is recentered and resized to +- fit_sigmas of the last fit on each iteration,
+        between 2 bins and twice its starting size
+        :return: peak positions, standard deviations (ADU, binning removed) and the
+            counts in the last fit window
+        """
+        min_half = 2*self.bin_width
+        max_half = np.maximum(2*fit_sigmas*sigma, min_half)
+        for _ in range(n_iter):
+            window_center = center
+            half = np.clip(fit_sigmas*sigma, min_half, max_half)
+            center, sigma = _log_parabola_wls(counts, self.xdata, window_center, half, allowed)
+        with np.errstate(invalid='ignore'):
+            inside = np.abs(self.xdata[None] - window_center[:, None]) <= half[:, None]
+            sigma = np.sqrt(sigma**2 - self.bin_width**2 / 12.)
+        if allowed is not None:
+            inside &= allowed
+        return center, sigma, np.where(inside, counts, 0).sum(-1)
+
+    def fit(self, zero_range=5., n_sigma=4., min_photons=20, smooth_sigma=1., fit_sigmas=2.,
+            n_iter=3, chunk=16384):
+        """
+        locates the zero and one photon peak of every pixel
+        :param zero_range: the zero photon peak is searched for within +- zero_range ADU
+        :param n_sigma: the one photon peak is searched for beyond n_sigma zero photon widths
+        :param min_photons: minimum counts in the fit window of the one photon peak
+        :param smooth_sigma: width (in bins) of the gaussian smoothing used to locate the peaks
+        :param fit_sigmas: the peaks are fit over +- fit_sigmas standard deviations
+        :param n_iter: number of refits of each peak
+        :param chunk: pixels fit per batch, sets the memory use
+        :return: per-pixel arrays of the one photon ADU (distance between the peaks) and
+            of the zero photon standard deviation, nan where the fit failed
+        """
+        half = int(np.ceil(4*smooth_sigma))
+        kernel = np.exp(-.5*(np.arange(-half, half+1) / float(smooth_sigma))**2)
+        kernel /= kernel.sum()
+        kernel_var = (smooth_sigma*self.bin_width)**2  # variance the smoothing adds to the peaks
+        zero_bins = np.abs(self.xdata) <= zero_range
+        zero_bins[[0, -1]] = False
+
+        photon_adu = np.full(self.npix, np.nan)
+        zero_width = np.full(self.npix, np.nan)
+        for i in range(0, self.npix, chunk):
+            counts = np.asarray(self.cube[i:i+chunk], dtype=np.float64)
+            smoothed = convolve1d(counts, kernel, axis=-1, mode='constant')
+            rows = np.arange(len(counts))
+
+            s = np.where(zero_bins, smoothed, -np.inf)
+            k0 = np.argmax(s, axis=-1)
+            _, sig0 = _log_parabola(smoothed, k0, self.bin_width)  # starting width
+            with np.errstate(invalid='ignore'):
+                sig0 = np.sqrt(sig0**2 - kernel_var)
+            sig0 = np.clip(np.where(np.isfinite(sig0), sig0, .5*zero_range), self.bin_width, zero_range)
+            mu0, sig0, _ = self._fit_peak(counts, self.xdata[k0], sig0, fit_sigmas, n_iter)
+
+            with np.errstate(invalid='ignore'):
+                one_bins = self.xdata[None] > (mu0 + n_sigma*sig0)[:, None]
+            one_bins[:, [0, -1]] = False
+            s = np.where(one_bins, smoothed, -np.inf)
+            k1 = np.argmax(s, axis=-1)
+            sig1 = np.where(np.isfinite(sig0), sig0, .5*zero_range)
+            mu1, _, n_photons = self._fit_peak(counts, self.xdata[k1], sig1, fit_sigmas, n_iter,
+                                               one_bins)
+            # a peak, not the edge of the zero photon tail
+            good = one_bins[rows, k1-1] & np.isfinite(mu1) & (n_photons >= min_photons)
+            photon_adu[i:i+chunk] = np.where(good, mu1 - mu0, np.nan)
+            zero_width[i:i+chunk] = sig0
+        return photon_adu.reshape(self.shape), zero_width.reshape(self.shape)
+
+    @staticmethod
+    def gain_map(photon_adu, nominal_scale, reference=None):
+        """
+        per-pixel multiplier that brings every pixel to the reference photon ADU
+        :param photon_adu: one photon ADU of each pixel, from fit
+        :param nominal_scale: per-pixel nominal gain the shots were scaled by
+            (gain_val for low gain pixels, 1 for high gain pixels)
+        :param reference: reference one photon ADU, median of photon_adu if None
+        :return: per-pixel gain map, the nominal scale where the fit failed
+        """
+        if reference is None:
+            reference = np.nanmedian(photon_adu)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            factor = reference / photon_adu
+        factor[~np.isfinite(factor)] = 1
+        return nominal_scale * factor
+
+    def flush(self):
+        self.cube.flush()
+
+
+def save_gain_map(gain_map_file, pixel_gain, zero_width=None):
+    """
+    writes the per-pixel gain map to its own hdf5 file. FormatHDF5D9114 uses it in
+    place of the scalar gain_val when its PIXEL_GAIN_FILE is set to gain_map_file
+    """
+    with h5py.File(gain_map_file, 'w') as h5:
+        h5.create_dataset("pixel_gain_map", data=pixel_gain)
+        if zero_width is not None:
+            h5.create_dataset("pixel_zero_width", data=zero_width)
+
+
+def load_gain_map(gain_map_file):
+    """:return: the per-pixel gain map written by save_gain_map"""
+    with h5py.File(gain_map_file, 'r') as h5:
+        return h5["pixel_gain_map"][()]
+
+
+def calibrate_hit_file(hit_file, cube_file, gain_map_file, pppg_args, **fit_kwargs):
+    """
+    per-pixel gain calibration from the shots of a hit file
+    :param hit_file: hdf5 hit file, it is only read
+    :param cube_file: path of the count cube
+    :param gain_map_file: path of the gain map file written
+    :param pppg_args: common mode parameters
+    :return: the calibrator and the gain map
+    """
+    from cxid9114.format.correct_utils import FrameCorrector
+    with h5py.File(hit_file, 'r') as h5:
+        dark = h5["pedestal"][()]
+        gain = h5["panel_gainmasks"][()]
+        mask = h5["panel_masks"][()]
+        gain_val = h5["gain_val"][()]
+        corrector = FrameCorrector(dark, gain, mask, gain_val, pppg_args=pppg_args,
+                                   dtype=np.float64, apply_mask=False)
+        panels = h5["panels"]
+        calib = PixelGainCalibrator(cube_file, shape=dark.shape)
+        for i in range(panels.shape[0]):
+            calib.add(corrector.correct(panels[i]))
+            print("\rAdded shot %d/%d" % (i+1, panels.shape[0]), end="")
+        print("")
+    calib.flush()
+    photon_adu, zero_width = calib.fit(**fit_kwargs)
+    photon_adu[~mask] = np.nan
+    pixel_gain = calib.gain_map(photon_adu, np.where(gain, gain_val, 1.))
+    save_gain_map(gain_map_file, pixel_gain, zero_width)
+    return calib, pixel_gain
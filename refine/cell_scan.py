@@ -3,6 +3,7 @@ from scitbx.matrix import sqr
 import numpy as np
 from cxid9114.sim import sim_utils
 from cxid9114.spots import spot_utils
+from cxid9114 import utils
 
 def refine_cell(data):
 
@@ -21,38 +22,38 @@ def refine_cell(data):
     crystal.set_U(Op)
 
     overlaps = []
-    imgs_all = []
     percs = np.arange( -0.005, 0.006, 0.001)
     crystals = []
-    for i in percs:
-        for j in percs:
-            crystal2 = deepcopy(crystal)
-            a2 = a + a*i
-            c2 = c + c*j
-            B2 = sqr((a2, 0, 0, 0, a2, 0, 0, 0, c2)).inverse()
-            crystal2.set_B(B2)
-            sim_patt = Patts.make_pattern2(crystal=crystal2,
-                                       flux_per_en=[data['fracA']*1e14, data['fracB']*1e14],
-                                       energies_eV=energy,
-                                       fcalcs_at_energies=fcalc,
-                                       mosaic_spread=None,
-                                       mosaic_domains=None,
-                                       ret_sum=True,
-                                       Op=None)
-
-            sim_sig_mask = sim_patt > 0
-            overlaps.append( np.sum(sim_sig_mask * spot_mask))
-            crystals.append( deepcopy(crystal2))
-            imgs_all.append( sim_patt)
-    refls_all = [data["refl"]] * len( imgs_all)
-    utils.images_and_refls_to_simview("cell_refine", imgs_all, refls_all)
+    with utils.SimviewWriter("cell_refine", (1800, 1800)) as writer:  # images are written as they are simulated
+        for i in percs:
+            for j in percs:
+                crystal2 = deepcopy(crystal)
+                a2 = a + a*i
+                c2 = c + c*j
+                B2 = sqr((a2, 0, 0, 0, a2, 0, 0, 0, c2)).inverse()
+                crystal2.set_B(B2)
+                sim_patt = Patts.make_pattern2(crystal=crystal2,
+                                           flux_per_en=[data['fracA']*1e14, data['fracB']*1e14],
+                                           energies_eV=energy,
+                                           fcalcs_at_energies=fcalc,
+                                           mosaic_spread=None,
+                                           mosaic_domains=None,
+                                           ret_sum=True,
+                                           Op=None)
+
+                sim_sig_mask = sim_patt > 0
+                overlaps.append( np.sum(sim_sig_mask * spot_mask))
+                crystals.append( deepcopy(crystal2))
+                writer.append( sim_patt)
+        refls_all = [data["refl"]] * len( writer)
+        utils.refls_to_simview("cell_refine", refls_all, len(writer))
+        print "Wrote %s" % writer.filename
     return overlaps, crystals
 
 
 
 if __name__ == "__main__":
     import sys
-    from cxid9114 import utils
     data = utils.open_flex(sys.argv[1])
     results, crystals = refine_cell(data)
 
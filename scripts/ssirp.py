@@ -33,6 +33,12 @@ from dxtbx.datablock import DataBlockFactory
 from dials.array_family import flex
 from dxtbx.model import Detector
 import os
+try:
+    from mpi4py import MPI
+    RANK, SIZE = MPI.COMM_WORLD.Get_rank(), MPI.COMM_WORLD.Get_size()
+except ImportError:
+    RANK, SIZE = 0, 1
+TAG = "_rank%d" % RANK if SIZE > 1 else ""  # under mpirun each rank processes every SIZE-th shot
 
 fcalc_f = "/Users/dermen/cxid9114_gain/sim/fcalc_slim.pkl"
 outdir = "ssirp_res_det.refine"
@@ -67,7 +73,11 @@ spot_par_moder.spotfinder.lookup.mask = "../mask/dials_mask_64panels_2.pkl"
 #spot_par_moder.spotfinder.lookup.mask = "../mask/dials_mask2d.pickle"
 
 img_f = "xtc_102.loc"
+if SIZE > 1 and RANK > 0:
+    MPI.COMM_WORLD.Barrier()  # rank 0 writes the event index and calibration disk cache first
 loader = dxtbx.load(img_f)
+if SIZE > 1 and RANK == 0:
+    MPI.COMM_WORLD.Barrier()
 
 
 def load_tracker_f(fname):
@@ -80,9 +90,9 @@ def load_tracker_f(fname):
 
 skip_weak = True
 skip_failed = True
-weak_shots_f = os.path.join(outdir, "weak_shots.txt")
-failed_idx_f = os.path.join(outdir, "failed_shots.txt")
-indexed_f = os.path.join(outdir, "indexed_shots.txt")
+weak_shots_f = os.path.join(outdir, "weak_shots%s.txt" % TAG)
+failed_idx_f = os.path.join(outdir, "failed_shots%s.txt" % TAG)
+indexed_f = os.path.join(outdir, "indexed_shots%s.txt" % TAG)
 weak_shots = load_tracker_f(weak_shots_f)
 failed_shots = load_tracker_f(failed_idx_f)
 indexed_shots = load_tracker_f(indexed_f)
@@ -93,7 +103,7 @@ DETECTOR = IMGSET.get_detector(0)
 Nprocessed = 0
 crystals = {}
 N = len(IMGSET)  # number to process
-for idx in range(N):
+for idx in range(RANK, N, SIZE):
     if idx in weak_shots and skip_weak:
         print("Skipping weak shots %d" % idx)
         continue
@@ -146,12 +156,12 @@ for idx in range(N):
     indexed_shots.append(idx)
     np.savetxt(indexed_f, indexed_shots, fmt="%d")
 
-    exp_name = os.path.join(outdir, "exp_%d.json" % Nprocessed )
-    refl_name = os.path.join(outdir, "refl_%d.pkl" % Nprocessed)
+    exp_name = os.path.join(outdir, "exp_%d%s.json" % (Nprocessed, TAG))
+    refl_name = os.path.join(outdir, "refl_%d%s.pkl" % (Nprocessed, TAG))
     orient.export_as_json(orient.refined_experiments, file_name=exp_name)
     utils.save_flex(orient.refined_reflections, refl_name)
 
     crystals[idx] = orient.refined_experiments.crystals()[0]
     Nprocessed += 1
-utils.save_flex(crystals, os.path.join(outdir, "ssirp_cryst_r102.pkl"))
+utils.save_flex(crystals, os.path.join(outdir, "ssirp_cryst_r102%s.pkl" % TAG))
 
@@ -131,33 +131,34 @@ sim_utils.save_fcalc_file(energies, fcalcs_at_en, filename="fcalc_slim.pkl")
 # so we can compare original with simulated indexed visually
 
 if make_output:
-    output_imgs = []
     output_refls = []
     output_pref = "output"
-    for hit_idx in some_good_hits[:Nout]:
-        #sim_img = Patts.make_pattern(
-        #    crystal=data[hit_idx]['crystals'][0],
-        #    spectrum=data[hit_idx]['spectrum'],
-        #    show_spectrum=False)
-
-        cryst = data[hit_idx]["crystals"][0]
-        fracA = data[hit_idx]['fracA']
-        fracB = data[hit_idx]['fracB']
-        flux_per_en = [ fracA * 1e14, fracB*1e14]
-
-        sim_patt = Patts.make_pattern2( crystal=cryst,
-                                flux_per_en=flux_per_en,
-                                energies_eV=energies,
-                                fcalcs_at_energies=fcalcs_at_en,
-                                mosaic_spread=None,
-                                mosaic_domains=None,
-                                ret_sum=True)
-        actual_img = loader.get_raw_data(hit_idx).as_numpy_array().astype(np.float32)
-        refl = data[hit_idx]['refl']
-        output_imgs.extend([sim_patt, actual_img])
-        output_refls.extend([refl,refl])
-
-    utils.images_and_refls_to_simview(output_pref, output_imgs, output_refls)
+    with utils.SimviewWriter(output_pref, img_shape=None) as writer:  # images are written as they are made
+        for hit_idx in some_good_hits[:Nout]:
+            #sim_img = Patts.make_pattern(
+            #    crystal=data[hit_idx]['crystals'][0],
+            #    spectrum=data[hit_idx]['spectrum'],
+            #    show_spectrum=False)
+
+            cryst = data[hit_idx]["crystals"][0]
+            fracA = data[hit_idx]['fracA']
+            fracB = data[hit_idx]['fracB']
+            flux_per_en = [ fracA * 1e14, fracB*1e14]
+
+            sim_patt = Patts.make_pattern2( crystal=cryst,
+                                    flux_per_en=flux_per_en,
+                                    energies_eV=energies,
+                                    fcalcs_at_energies=fcalcs_at_en,
+                                    mosaic_spread=None,
+                                    mosaic_domains=None,
+                                    ret_sum=True)
+            actual_img = loader.get_raw_data(hit_idx).as_numpy_array().astype(np.float32)
+            refl = data[hit_idx]['refl']
+            writer.append(sim_patt)
+            writer.append(actual_img)
+            output_refls.extend([refl,refl])
+
+        utils.refls_to_simview(output_pref, output_refls, len(writer))
     #os.system("dials.image_viewer %s %s" % \
     #          (output_pref+".h5", output_pref+"_strong.pkl"))
 
@@ -177,28 +178,28 @@ rotXY_series = [ (xRot(i, deg=True), yRot(j, deg=True)) for i in degs for j in d
 # TEST rotation about beam!
 #
 if test_zRot:
-    output_imgs = []
     output_refls = []
     output_pref = "zRot_output"
-    hit_idx = some_good_hits[0]
-    for i in np.linspace(0,2,20):
-        cryst = data[hit_idx]["crystals"][0]
-        fracA = data[hit_idx]['fracA']
-        fracB = data[hit_idx]['fracB']
-        refl = data[hit_idx]["refl"]
-        flux_per_en = [ fracA * 1e12, fracB*1e12]
-        sim_patt = Patts.make_pattern2( crystal=deepcopy(cryst),
-                                flux_per_en=flux_per_en,
-                                energies_eV=energies,
-                                fcalcs_at_energies=fcalcs_at_en,
-                                mosaic_spread=None,
-                                mosaic_domains=None,
-                                ret_sum=True,
-                                Op=zRot(i, deg=True))
-        output_imgs.extend([sim_patt])
-        output_refls.extend([refl])
-
-    utils.images_and_refls_to_simview(output_pref, output_imgs, output_refls)
+    with utils.SimviewWriter(output_pref, img_shape=None) as writer:
+        hit_idx = some_good_hits[0]
+        for i in np.linspace(0,2,20):
+            cryst = data[hit_idx]["crystals"][0]
+            fracA = data[hit_idx]['fracA']
+            fracB = data[hit_idx]['fracB']
+            refl = data[hit_idx]["refl"]
+            flux_per_en = [ fracA * 1e12, fracB*1e12]
+            sim_patt = Patts.make_pattern2( crystal=deepcopy(cryst),
+                                    flux_per_en=flux_per_en,
+                                    energies_eV=energies,
+                                    fcalcs_at_energies=fcalcs_at_en,
+                                    mosaic_spread=None,
+                                    mosaic_domains=None,
+                                    ret_sum=True,
+                                    Op=zRot(i, deg=True))
+            writer.append(sim_patt)
+            output_refls.extend([refl])
+
+        utils.refls_to_simview(output_pref, output_refls, len(writer))
 
 #
 # TEST Full spectrum vs simple two color
@@ -249,7 +250,6 @@ if spec_compare:
 #
 
 if XYscan:
-    output_imgs =[]
     output_refls = []
     hit_idx = some_good_hits[0]
     cryst = data[hit_idx]["crystals"][0]
@@ -258,19 +258,20 @@ if XYscan:
     fracB = data[hit_idx]['fracB']
     flux_per_en = [fracA * 1e14, fracB * 1e14]
     output_pref = "xyscan_xtal_fine_%d" % hit_idx
-    for i_rot, (rX,rY) in enumerate(rotXY_series):
-        sim_patt = Patts.make_pattern2( crystal=deepcopy(cryst),
-                                        flux_per_en=flux_per_en,
-                                        energies_eV=energies,
-                                        fcalcs_at_energies=fcalcs_at_en,
-                                        mosaic_spread=None,
-                                        mosaic_domains=None,
-                                        ret_sum=True,
-                                        Op=rX*rY)
-        output_imgs.append( sim_patt)
-        output_refls.append( refl)
-        print "Rot %d / %d" % (i_rot+1, len(rotXY_series))
-    utils.images_and_refls_to_simview(output_pref, output_imgs, output_refls)
+    with utils.SimviewWriter(output_pref, img_shape=None) as writer:
+        for i_rot, (rX,rY) in enumerate(rotXY_series):
+            sim_patt = Patts.make_pattern2( crystal=deepcopy(cryst),
+                                            flux_per_en=flux_per_en,
+                                            energies_eV=energies,
+                                            fcalcs_at_energies=fcalcs_at_en,
+                                            mosaic_spread=None,
+                                            mosaic_domains=None,
+                                            ret_sum=True,
+                                            Op=rX*rY)
+            writer.append( sim_patt)
+            output_refls.append( refl)
+            print "Rot %d / %d" % (i_rot+1, len(rotXY_series))
+        utils.refls_to_simview(output_pref, output_refls, len(writer))
 
 
 def save_results(data_img, crystal, refl, fcalc_file, Xang, Yang, filename):
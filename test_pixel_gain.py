@@ -0,0 +1,59 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from cxid9114.pixel_gain import PixelGainCalibrator
+
+"""
+Checks that PixelGainCalibrator recovers the zero photon width and the
+per-pixel one photon ADU of synthetic shots,
+run with pytest or as a script
+"""
+
+
+def _calibrate(n_shots, sigma, occupancy, shape=(4, 20, 20), seed=0):
+    """
+    fits a count cube of synthetic shots, gaussian zero photon noise of width sigma
+    and one photon peaks at a per-pixel ADU spread by 8% around 25 ADU
+    :return: the fitted one photon ADU and zero photon width, and the true one photon ADU
+    """
+    rng = np.random.RandomState(seed)
+    npix = int(np.prod(shape))
+    photon_adu = 25 * (1 + .08*rng.randn(npix))
+    tmp = tempfile.mkdtemp()
+    try:
+        calib = PixelGainCalibrator(os.path.join(tmp, "cube.dat"), shape=shape)
+        for _ in range(n_shots):
+            photons = rng.rand(npix) < occupancy
+            shot = sigma*rng.randn(npix) + photons*(photon_adu + .5*rng.randn(npix))
+            calib.add(shot.reshape(shape))
+        fit_adu, zero_width = calib.fit()
+        del calib
+    finally:
+        shutil.rmtree(tmp)
+    return fit_adu.ravel(), zero_width.ravel(), photon_adu
+
+
+def test_zero_width():
+    for sigma in (1., 2., 3.):
+        _, zero_width, _ = _calibrate(1500, sigma, .2)
+        assert np.all(np.isfinite(zero_width))
+        assert abs(np.median(zero_width) / sigma - 1) < .02
+        assert np.percentile(np.abs(zero_width / sigma - 1), 90) < .1
+
+
+def test_photon_adu():
+    for occupancy in (.05, .2):
+        fit_adu, _, photon_adu = _calibrate(1500, 2., occupancy)
+        assert np.all(np.isfinite(fit_adu))
+        err = np.abs(fit_adu / photon_adu - 1)
+        assert np.median(err) < .01
+        assert np.percentile(err, 99) < .05
+
+
+if __name__ == "__main__":
+    test_zero_width()
+    test_photon_adu()
+    print("OK")
@@ -267,13 +267,63 @@ class GetSpectrum:
         #else:
         #    return self.project_fee_img(data)
 
-def images_and_refls_to_simview(prefix, imgs, refls):
-
+class SimviewWriter(object):
+    """
+    Writes simulated images to <prefix>.h5 for FormatSimulationD9114 as they are made,
+    each appended to a resizable float32 dataset chunked one image per chunk,
+    so the images never need to be in memory together
+    """
+    def __init__(self, prefix, img_shape=(1800, 1800)):
+        """
+        :param prefix: the file is <prefix>.h5
+        :param img_shape: shape of the images, None takes it from the first image
+        """
+        self.h5 = h5py.File("%s.h5" % prefix, "w")
+        self.filename = self.h5.filename
+        self.dset = None
+        if img_shape is not None:
+            self._create_dataset(tuple(img_shape))
+
+    def _create_dataset(self, img_shape):
+        self.dset = self.h5.create_dataset("simulated_d9114_images",
+                                           shape=(0,) + img_shape,
+                                           maxshape=(None,) + img_shape,
+                                           chunks=(1,) + img_shape,
+                                           dtype=np.float32)
+
+    def __len__(self):
+        if self.dset is None:
+            return 0
+        return self.dset.shape[0]
+
+    def append(self, img):
+        """appends one image, converted to float32"""
+        if self.dset is None:
+            self._create_dataset(np.shape(img))
+        n = self.dset.shape[0]
+        self.dset.resize(n+1, axis=0)
+        self.dset[n] = np.asarray(img, dtype=np.float32)
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def refls_to_simview(prefix, refls, Nimg):
+    """
+    writes the strong reflections of the images of a SimviewWriter to <prefix>_strong.pkl
+    :param refls: list of one reflection table per image
+    :param Nimg: number of images
+    """
     refls_concat = spot_utils.combine_refls(refls)
     refl_info = count_spots.group_refl_by_shotID(refls_concat)
     refl_shotIds = refl_info.keys()
     Nrefl = len( refl_shotIds)
-    Nimg = len( imgs)
 
     assert(Nimg==Nrefl)
     assert( all([ i in range(Nrefl) for i in refl_shotIds]))
@@ -282,10 +332,15 @@ def images_and_refls_to_simview(prefix, imgs, refls):
         cPickle.dump(refls_concat, strong_f)
         print "Wrote %s" % strong_f.name
 
-    with h5py.File( "%s.h5" % prefix, "w") as img_f:
-        for i_img in range(Nimg):
-            if imgs[i].dtype != np.float32:
-                imgs[i] = imgs[i].astype(np.float32)
-        img_f.create_dataset("simulated_d9114_images",
-                             data=imgs)
-        print "Wrote %s" % img_f.filename
+
+def images_and_refls_to_simview(prefix, imgs, refls):
+
+    refls_to_simview(prefix, refls, len(imgs))
+
+    if not len(imgs):
+        print "No images to write to %s.h5" % prefix
+        return
+    with SimviewWriter(prefix, np.shape(imgs[0])) as writer:
+        for img in imgs:
+            writer.append(img)
+        print "Wrote %s" % writer.filename